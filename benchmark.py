@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+   Author: M I Schwartz
+
+   Offline microbenchmarks for the credit card validation service.
+   No server is needed; the modules are exercised directly.
+
+   Groups:
+    * validation  - validation_utilities (vendor, Luhn, CVV, date)
+    * transaction - CCTransaction construction and JSON round trips
+    * datastore   - store / settle / listing at 10^3 to 10^6 entries
+    * settlement  - CCSettlement.settle and to_json on large batches
+    * ccstore     - load time of synthetic enrolled card books
+    * wire        - JSON vs MessagePack encode / decode and payload size
+
+   Usage::
+       python3 benchmark.py                          # full run
+       python3 benchmark.py --quick                  # smaller sizes
+       python3 benchmark.py --output baseline.json   # save results
+       python3 benchmark.py --baseline baseline.json # compare; exit 1 on regression
+
+   Results are JSON:
+       { "meta": {...},
+         "results": { name: {"seconds_per_op": float, "ops": int}, ... } }
+   The wire group's results also carry "bytes", the encoded payload size.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import uuid
+
+import datastore
+import validation_utilities
+import wire_format
+
+from cc_settlement import CCSettlement
+from cc_transaction import CCTransaction
+
+# Sizes used by the datastore, settlement and ccstore groups
+FULL_SIZES = (1000, 10000, 100000, 1000000)
+QUICK_SIZES = (1000, 10000)
+# Settlement and card books are slower per item; cap them separately
+SETTLEMENT_MAX = 100000
+CCSTORE_MAX = 100000
+
+# A result is a regression if it is this much slower than the baseline
+DEFAULT_THRESHOLD = 0.10
+
+VISA = "4140-1233-3445-4561"
+AMEX = "3782-822463-10005"
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Several of the timed functions print; send that to /dev/null"""
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def _luhn_complete(partial):
+    """Append the Luhn check digit to a string of digits"""
+    digit_sum = 0
+    for i, char in enumerate(reversed(partial)):
+        j = int(char)
+        if i % 2 == 0:
+            j = j * 2
+            if j > 9:
+                j = j - 9
+        digit_sum = digit_sum + j
+    return partial + str((10 - digit_sum % 10) % 10)
+
+
+def _exp_year():
+    return str(datetime.date.today().year + 2)
+
+
+def _approved_transaction(index):
+    """Builds the dict of an approved, authorized transaction as the service stores it"""
+    transaction = CCTransaction("Benchmark Holder", VISA, "123", "12", _exp_year(), "usd")
+    transaction.set_amount(1000 + index)
+    transaction.set_merchant_data("Benchmark Merchant", "merch_%d" % (index % 100))
+    transaction.data["card"]["valid"] = True
+    transaction.data["card"]["type"] = "visa"
+    transaction.data["approved"] = True
+    transaction.data["authorized"] = True
+    transaction.data["failure_code"] = ""
+    transaction.data["failure_message"] = ""
+    transaction.data["approval_code"] = "appr_" + str(uuid.uuid4())
+    return transaction
+
+
+def _synthetic_card_book(count):
+    """Returns a list of enrolled card records with distinct, valid card numbers"""
+    cards = []
+    for i in range(count):
+        card_id = _luhn_complete("414012%09d" % i)
+        cards.append({
+            "authorizing_bank": "Benchmark Bank, 100-00000",
+            "card_code": "123",
+            "card_limit": "300000",
+            "currency": "usd",
+            "customer_id": "CUST_%09d" % i,
+            "exp_month": "12",
+            "exp_year": _exp_year(),
+            "id": card_id,
+            "name": "Holder %d" % i,
+            "zip_code": "80210"
+        })
+    return cards
+
+
+def _time(func, number=1, repeat=3, setup=None):
+    """
+    Best-of-repeat wall time per operation.
+    func is called once per repeat and performs `number` operations;
+    setup, if given, runs untimed before each repeat.
+    """
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with _quiet():
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number
+
+
+def _loop(func, number):
+    def run():
+        for _ in range(number):
+            func()
+    return run
+
+
+def bench_validation(record):
+    number = 20000
+    exp_year = _exp_year()
+    record("validation.credit_card_vendor", number,
+           _time(_loop(lambda: validation_utilities.credit_card_vendor(VISA), number), number))
+    record("validation.verify_luhn", number,
+           _time(_loop(lambda: validation_utilities.verify_luhn(VISA), number), number))
+    record("validation.validate_cvv", number,
+           _time(_loop(lambda: validation_utilities.validate_cvv(AMEX, "1234"), number), number))
+    record("validation.validate_date", number,
+           _time(_loop(lambda: validation_utilities.validate_date("12", exp_year), number), number))
+    record("validation.validate_card", number,
+           _time(_loop(lambda: validation_utilities.validate_card(VISA, "123", True), number),
+                 number))
+
+
+def bench_transaction(record):
+    number = 10000
+    exp_year = _exp_year()
+    record("transaction.construct", number,
+           _time(_loop(lambda: CCTransaction("Benchmark Holder", VISA, "123", "12",
+                                             exp_year, "usd"), number), number))
+    transaction = _approved_transaction(0)
+    as_json = transaction.to_json()
+    record("transaction.to_json", number, _time(_loop(transaction.to_json, number), number))
+    record("transaction.from_json", number,
+           _time(_loop(lambda: CCTransaction.from_json(as_json), number), number))
+
+    def validate():
+        candidate = CCTransaction.from_json(as_json)
+        candidate.validate_transaction()
+    record("transaction.validate_transaction", number, _time(_loop(validate, number), number))
+
+    batch = [_approved_transaction(i) for i in range(1000)]
+    batch_json = CCTransaction.list_to_json(batch)
+    record("transaction.list_to_json[n=1000]", len(batch),
+           _time(lambda: CCTransaction.list_to_json(batch), len(batch)))
+    record("transaction.json_to_list[n=1000]", len(batch),
+           _time(lambda: CCTransaction.json_to_list(batch_json), len(batch)))
+
+
+def bench_datastore(record, sizes):
+    template = _approved_transaction(0).data
+    for size in sizes:
+        rows = []
+        for i in range(size):
+            row = dict(template)
+            row["approval_code"] = "appr_%d" % i
+            rows.append(row)
+        codes = [row["approval_code"] for row in rows]
+
+        def clear():
+            datastore._DATASTORE.clear()
+
+        def fill():
+            clear()
+            for row in rows:
+                datastore.store(row)
+
+        def store_all():
+            for row in rows:
+                datastore.store(row)
+
+        def settle_all():
+            for code in codes:
+                datastore.settle(code)
+
+        repeat = 3 if size < 1000000 else 1
+        record("datastore.store[n=%d]" % size, size,
+               _time(store_all, size, repeat, setup=clear))
+        record("datastore.settle[n=%d]" % size, size,
+               _time(settle_all, size, repeat, setup=fill))
+        fill()
+        record("datastore.get_unsettled_keys[n=%d]" % size, 1,
+               _time(datastore.get_unsettled_keys, 1, repeat))
+        record("datastore.get_unsettled[n=%d]" % size, 1,
+               _time(datastore.get_unsettled, 1, repeat))
+        clear()
+
+
+def bench_settlement(record, sizes):
+    for size in [s for s in sizes if s <= SETTLEMENT_MAX]:
+        batch = [_approved_transaction(i) for i in range(size)]
+        rows = [transaction.data for transaction in batch]
+
+        def fill():
+            datastore._DATASTORE.clear()
+            for row in rows:
+                row.pop("settlement_id", None)
+                datastore.store(row)
+
+        record("settlement.settle[n=%d]" % size, size,
+               _time(lambda: CCSettlement.settle(batch), size, setup=fill))
+        fill()
+        with _quiet():
+            settlement = CCSettlement.settle(batch)
+        record("settlement.to_json[n=%d]" % size, size,
+               _time(settlement.to_json, size))
+        datastore._DATASTORE.clear()
+
+
+def bench_ccstore(record, sizes):
+    with _quiet():
+        import ccstore
+    for size in [s for s in sizes if s <= CCSTORE_MAX]:
+        handle, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(handle, "w") as f:
+                json.dump(_synthetic_card_book(size), f)
+            record("ccstore.load[n=%d]" % size, size,
+                   _time(lambda: ccstore._init_ccstore(path), size,
+                         setup=ccstore._CCSTORE.clear))
+        finally:
+            os.remove(path)
+            ccstore._CCSTORE.clear()
+            with _quiet():
+                ccstore._init_ccstore(ccstore._CC_FILE_NAME)
+
+
+def bench_wire(record):
+    """A micro-batch of 1000 transactions, as /api/validate and /api/settle carry them"""
+    batch = [_approved_transaction(i).data for i in range(1000)]
+    as_json = json.dumps(batch).encode("utf-8")
+    as_msgpack = wire_format.packb(batch)
+    record("wire.json_encode[n=1000]", len(batch),
+           _time(lambda: json.dumps(batch).encode("utf-8"), len(batch)), len(as_json))
+    record("wire.json_decode[n=1000]", len(batch),
+           _time(lambda: json.loads(as_json), len(batch)), len(as_json))
+    record("wire.msgpack_encode[n=1000]", len(batch),
+           _time(lambda: wire_format.packb(batch), len(batch)), len(as_msgpack))
+    record("wire.msgpack_decode[n=1000]", len(batch),
+           _time(lambda: wire_format.unpackb(as_msgpack), len(batch)), len(as_msgpack))
+
+
+GROUPS = ("validation", "transaction", "datastore", "settlement", "ccstore", "wire")
+
+
+def run(groups=GROUPS, sizes=FULL_SIZES):
+    """Runs the selected benchmark groups and returns the results document"""
+    results = {}
+
+    def record(name, ops, seconds_per_op, size=None):
+        results[name] = {"seconds_per_op": seconds_per_op, "ops": ops}
+        if size is None:
+            print("%-45s %12.3f us/op" % (name, seconds_per_op * 1e6))
+        else:
+            results[name]["bytes"] = size
+            print("%-45s %12.3f us/op %10d bytes" % (name, seconds_per_op * 1e6, size))
+        sys.stdout.flush()
+
+    for group in groups:
+        if group == "validation":
+            bench_validation(record)
+        elif group == "transaction":
+            bench_transaction(record)
+        elif group == "datastore":
+            bench_datastore(record, sizes)
+        elif group == "settlement":
+            bench_settlement(record, sizes)
+        elif group == "ccstore":
+            bench_ccstore(record, sizes)
+        elif group == "wire":
+            bench_wire(record)
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "sizes": list(sizes),
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares two results documents.
+    Returns a list of (name, baseline, current, ratio) for each regression.
+    """
+    regressions = []
+    print("\n%-45s %12s %12s %8s" % ("benchmark", "baseline", "current", "ratio"))
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["seconds_per_op"]
+        after = result["seconds_per_op"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append((name, before, after, ratio))
+        print("%-45s %10.3fus %10.3fus %7.2fx%s" % (name, before * 1e6, after * 1e6, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline microbenchmarks")
+    parser.add_argument("--quick", action="store_true",
+                        help="use sizes %s instead of %s" % (QUICK_SIZES, FULL_SIZES))
+    parser.add_argument("--group", action="append", choices=GROUPS,
+                        help="run only this group (may be repeated)")
+    parser.add_argument("--output", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="compare against a saved results JSON file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown before a result is a regression (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    results = run(groups=args.group or GROUPS,
+                  sizes=QUICK_SIZES if args.quick else FULL_SIZES)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\n%d regression(s) beyond %.0f%%" % (len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
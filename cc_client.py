@@ -0,0 +1,460 @@
+"""
+Author: M I Schwartz
+
+Client classes for merchants calling the credit card validation service.
+
+CCClient (threads) and AsyncCCClient (asyncio) both:
+    * keep a pool of keep-alive connections, including TLS on port 8443
+    * micro-batch authorizations: authorize() queues a transaction and
+      returns a future; queued transactions are sent together as one
+      /api/validate list once max_batch are waiting or max_delay has passed
+    * keep approved transactions in a local buffer, so settle() builds the
+      settlement batch without the merchant tracking approval codes
+
+CCClient(..., msgpack=True) sends and asks for MessagePack instead of JSON.
+
+Example::
+
+    with CCClient("http://localhost:8000") as client:
+        futures = [client.authorize(transaction) for transaction in transactions]
+        approved = [future.result() for future in futures]
+        settlement = client.settle()
+
+    async with AsyncCCClient("https://localhost:8443", verify=False) as client:
+        approved = await client.authorize(transaction)
+        settlement = await client.settle()
+"""
+
+import asyncio
+import gzip
+import json
+import logging
+import queue
+import ssl
+import threading
+import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+import wire_format
+
+from cc_settlement import CCSettlement
+from cc_transaction import CCTransaction
+
+DEFAULT_URL = "http://localhost:8000"
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_BATCH = 50
+DEFAULT_MAX_DELAY = 0.005   # seconds an authorization may wait for a batch to fill
+DEFAULT_TIMEOUT = 10
+DEFAULT_COMPRESS_MIN_SIZE = 8192   # request bodies this large are sent gzip-compressed
+
+
+def _settlement_from_json(json_string):
+    """
+    Builds a CCSettlement from a /api/settle response as-is.
+    (CCSettlement.from_json re-settles transactions that lack a settlement id.)
+    """
+    return _settlement_from_dict(json.loads(json_string))
+
+
+def _settlement_from_dict(expand):
+    """Builds a CCSettlement from a decoded /api/settle response"""
+    result = CCSettlement()
+    result.settlement_id = expand["settlement_id"]
+    result.transactions = [CCTransaction.from_dict(t) for t in expand["transactions"]]
+    result.unsettled = [CCTransaction.from_dict(t) for t in expand["unsettled"]]
+    return result
+
+
+class _SettlementBuffer:
+    """Approved transactions waiting to be settled"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._approved = []
+
+    def add(self, transaction):
+        if transaction.data.get("approval_code"):
+            with self._lock:
+                self._approved.append(transaction)
+
+    def take(self, limit=None):
+        with self._lock:
+            if limit is None or limit >= len(self._approved):
+                batch, self._approved = self._approved, []
+            else:
+                batch, self._approved = self._approved[:limit], self._approved[limit:]
+        return batch
+
+    def put_back(self, batch):
+        """Returns a batch taken for settlement that could not be sent, ahead of newer approvals"""
+        with self._lock:
+            self._approved[:0] = batch
+
+    def __len__(self):
+        return len(self._approved)
+
+
+class CCClient:
+    """Thread based client with pooled connections and micro-batched authorization"""
+
+    def __init__(self, base_url=DEFAULT_URL, pool_size=DEFAULT_POOL_SIZE,
+                 max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY,
+                 verify=True, timeout=DEFAULT_TIMEOUT,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE, msgpack=False):
+        """
+        verify is passed to requests: False for the self-signed localhost.pem,
+        or the path of a CA bundle.
+        pool_size is the number of connections, and of batches in flight.
+        Request bodies of compress_min_size bytes or more are gzip-compressed; None disables.
+        Responses are decompressed by requests, which asks for gzip.
+        msgpack selects MessagePack (wire_format) for requests and responses.
+        """
+        self.base_url = base_url.rstrip("/")
+        self.compress_min_size = compress_min_size
+        self.msgpack = msgpack
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.verify = verify
+        self.timeout = timeout
+        self.approved = _SettlementBuffer()
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._senders = ThreadPoolExecutor(max_workers=pool_size,
+                                           thread_name_prefix="cc-client")
+        self._queue = queue.Queue()
+        self._closed = False
+        self._batcher = threading.Thread(target=self._collect, name="cc-client-batcher",
+                                         daemon=True)
+        self._batcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _post(self, path, data):
+        """Posts data (encoded as JSON or MessagePack) and returns the decoded response"""
+        if self.msgpack:
+            payload = wire_format.packb(data)
+            headers = {"Content-Type": wire_format.CONTENT_TYPE,
+                       "Accept": wire_format.CONTENT_TYPE}
+        else:
+            payload = json.dumps(data).encode("utf-8")
+            headers = {"Content-Type": "application/json"}
+        if self.compress_min_size is not None and len(payload) >= self.compress_min_size:
+            payload = gzip.compress(payload)
+            headers["Content-Encoding"] = "gzip"
+        response = self._session.post(self.base_url + path, data=payload, headers=headers,
+                                      verify=self.verify, timeout=self.timeout)
+        response.raise_for_status()
+        if wire_format.is_msgpack(response.headers.get("Content-Type")):
+            return wire_format.unpackb(response.content)
+        return response.json()
+
+    def _collect(self):
+        """Gathers queued authorizations into batches and hands them to the senders"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            try:
+                while len(batch) < self.max_batch:
+                    item = self._queue.get(timeout=self.max_delay)
+                    if item is None:
+                        self._senders.submit(self._send_batch, batch)
+                        return
+                    batch.append(item)
+            except queue.Empty:
+                pass
+            self._senders.submit(self._send_batch, batch)
+
+    def _send_batch(self, batch):
+        try:
+            responses = [CCTransaction.from_dict(t) for t in
+                         self._post("/api/validate", [t.data for t, _ in batch])]
+            if len(responses) != len(batch):
+                raise ValueError("Expected %d responses, got %d" % (len(batch), len(responses)))
+        except Exception as err:
+            for _, future in batch:
+                future.set_exception(err)
+            return
+        for (_, future), response in zip(batch, responses):
+            self.approved.add(response)
+            future.set_result(response)
+
+    def authorize(self, transaction):
+        """
+        Queues a transaction for validation and authorization.
+        Returns a Future whose result is the transaction as returned by the service.
+        """
+        if self._closed:
+            raise RuntimeError("CCClient is closed")
+        future = Future()
+        self._queue.put((transaction, future))
+        return future
+
+    def authorize_many(self, transactions):
+        """Authorizes a list of transactions and waits for all of the results"""
+        futures = [self.authorize(transaction) for transaction in transactions]
+        return [future.result() for future in futures]
+
+    def settle(self, transactions=None, limit=None):
+        """
+        Settles the given transactions, or up to `limit` from the local
+        buffer of approved transactions. Returns a CCSettlement.
+        """
+        buffered = transactions is None
+        if buffered:
+            transactions = self.approved.take(limit)
+        if not transactions:
+            return CCSettlement()
+        try:
+            return _settlement_from_dict(self._post("/api/settle",
+                                                    [t.data for t in transactions]))
+        except BaseException:
+            # Keep the approvals for the next settle(); if the service did settle
+            # them before the failure, that settle reports them as 404
+            if buffered:
+                self.approved.put_back(transactions)
+            raise
+
+    def store(self, verbose=False):
+        """Returns the service's unsettled approval codes (or transactions if verbose)"""
+        return self._post("/api/store", {"verbose": verbose})
+
+    def close(self):
+        """Sends anything still queued, then releases the connections"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._batcher.join()
+        self._senders.shutdown(wait=True)
+        self._session.close()
+
+
+class _NoResponse(ConnectionError):
+    """The connection failed before any byte of a response arrived"""
+
+
+class _Connection:
+    """One keep-alive HTTP/1.1 connection for AsyncCCClient"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def request(self, host, path, body):
+        payload = body.encode("utf-8")
+        head = ("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+                "Content-Length: %d\r\n\r\n" % (path, host, len(payload)))
+        try:
+            self.writer.write(head.encode("latin-1") + payload)
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+        except (ConnectionResetError, BrokenPipeError) as err:
+            raise _NoResponse(str(err)) from err
+        if not status_line:
+            raise _NoResponse("Connection closed by the service")
+        status = int(status_line.split()[1])
+        length = 0
+        chunked = False
+        compressed = False
+        keep_alive = True
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding":
+                chunked = "chunked" in value
+            elif name == "content-encoding":
+                compressed = value == "gzip"
+            elif name == "connection" and value == "close":
+                keep_alive = False
+        if chunked:
+            body = await self._read_chunked()
+        else:
+            body = await self.reader.readexactly(length)
+        if compressed:
+            body = gzip.decompress(body)
+        return status, body.decode("utf-8"), keep_alive
+
+    async def _read_chunked(self):
+        blocks = []
+        while True:
+            size = int((await self.reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(blocks)
+            blocks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncCCClient:
+    """asyncio client with pooled connections and micro-batched authorization"""
+
+    def __init__(self, base_url=DEFAULT_URL, pool_size=DEFAULT_POOL_SIZE,
+                 max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY,
+                 verify=True, timeout=DEFAULT_TIMEOUT):
+        """verify may be False for the self-signed localhost.pem, or a CA bundle path"""
+        parsed = urllib.parse.urlsplit(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.host_header = parsed.netloc
+        self.ssl = None
+        if parsed.scheme == "https":
+            if verify is False:
+                self.ssl = ssl.create_default_context()
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+            elif isinstance(verify, str):
+                self.ssl = ssl.create_default_context(cafile=verify)
+            else:
+                self.ssl = ssl.create_default_context()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.approved = _SettlementBuffer()
+
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+        self._pending = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _post(self, path, body):
+        async with self._slots:
+            # A pooled connection may have been closed by the service while idle.
+            # Only then, when no response byte arrived, is the request sent again on a
+            # fresh connection: a request that got a partial response may have been
+            # processed (an authorization stored), and /api/validate is not idempotent.
+            while True:
+                pooled = bool(self._idle)
+                if pooled:
+                    connection = self._idle.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(self.host, self.port,
+                                                                   ssl=self.ssl)
+                    connection = _Connection(reader, writer)
+                try:
+                    status, text, keep_alive = await asyncio.wait_for(
+                        connection.request(self.host_header, path, body), self.timeout)
+                except _NoResponse:
+                    connection.close()
+                    if pooled:
+                        continue
+                    raise
+                except (ConnectionError, asyncio.IncompleteReadError, IndexError,
+                        ValueError) as err:
+                    connection.close()
+                    raise ConnectionError(str(err)) from err
+                except BaseException:
+                    connection.close()
+                    raise
+                if keep_alive:
+                    self._idle.append(connection)
+                else:
+                    connection.close()
+                if status != 200:
+                    raise ConnectionError("HTTP %d from %s: %s" % (status, path, text))
+                return text
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._send_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send_batch(self, batch):
+        try:
+            text = await self._post("/api/validate",
+                                    CCTransaction.list_to_json([t for t, _ in batch]))
+            responses = CCTransaction.json_to_list(text)
+            if len(responses) != len(batch):
+                raise ValueError("Expected %d responses, got %d" % (len(batch), len(responses)))
+        except Exception as err:
+            logging.debug("Authorization batch failed: %s", err)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for (_, future), response in zip(batch, responses):
+            self.approved.add(response)
+            if not future.done():
+                future.set_result(response)
+
+    def authorize(self, transaction):
+        """
+        Queues a transaction for validation and authorization.
+        Returns an awaitable Future whose result is the transaction as returned by the service.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((transaction, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_delay, self._flush)
+        return future
+
+    async def authorize_many(self, transactions):
+        """Authorizes a list of transactions and waits for all of the results"""
+        return await asyncio.gather(*[self.authorize(t) for t in transactions])
+
+    async def settle(self, transactions=None, limit=None):
+        """
+        Settles the given transactions, or up to `limit` from the local
+        buffer of approved transactions. Returns a CCSettlement.
+        """
+        buffered = transactions is None
+        if buffered:
+            transactions = self.approved.take(limit)
+        if not transactions:
+            return CCSettlement()
+        try:
+            return _settlement_from_json(await self._post("/api/settle",
+                                                          CCTransaction.list_to_json(transactions)))
+        except BaseException:
+            # Keep the approvals for the next settle(), as CCClient.settle does
+            if buffered:
+                self.approved.put_back(transactions)
+            raise
+
+    async def store(self, verbose=False):
+        """Returns the service's unsettled approval codes (or transactions if verbose)"""
+        return json.loads(await self._post("/api/store", json.dumps({"verbose": verbose})))
+
+    async def close(self):
+        """Sends anything still queued, then closes the pooled connections"""
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        while self._idle:
+            self._idle.pop().close()
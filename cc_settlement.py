@@ -31,13 +31,25 @@ Use case outline:
 
 """
 import json
+import logging
 import uuid
+
 import datastore
 
 from cc_transaction import CCTransaction
 
 # MAX_SETTLEMENTS = 100
 
+# Failure codes set on transactions returned in "unsettled"
+SETTLE_INCOMPLETE = 402        # Required fields are missing
+SETTLE_NOT_APPROVED = 403      # Not approved, or no approval code
+SETTLE_UNKNOWN = datastore.UNKNOWN_FAILURE    # 404: not outstanding (unknown or already settled)
+SETTLE_MISMATCH = datastore.MISMATCH_FAILURE  # 406: differs from the authorized transaction
+SETTLE_DUPLICATE = 409         # Approval code appears earlier in the same batch
+SETTLE_ALREADY_SETTLED = 410   # Approval code was settled before (found in the archive)
+SETTLE_EXPIRED = datastore.EXPIRED_FAILURE   # 412: the authorization expired unsettled
+SETTLE_NOT_RECORDED = 503      # The archive could not record it; it is unsettled again
+
 class CCSettlement:
     """
     A settlement object is a batch of transactions together with a settlement id
@@ -45,6 +57,9 @@ class CCSettlement:
 
     """
 
+    # A SettlementArchive that keeps settled transactions, if configured
+    archive = None
+
     def __init__(self):
         self.settlement_id = "pending"
         self.transactions = []
@@ -56,13 +71,15 @@ class CCSettlement:
         result = True
         message = []
         # Check card attributes
+        card = transaction.data.get("card", {})
         for attr in c_list:
-            if not attr in transaction.data["card"]:
+            if not attr in card:
                 message.append(attr + " not found in card data")
                 result = False
         # Check merchant attributes
+        merchant_data = transaction.data.get("merchant_data", {})
         for attr in m_list:
-            if not attr in transaction.data["merchant_data"]:
+            if not attr in merchant_data:
                 message.append(attr + " not found in merchant data")
                 result = False
         # Check for validity and authorization
@@ -71,42 +88,150 @@ class CCSettlement:
                 message.append(attr + " not found in transaction data")
                 result = False
         if len(message) > 0:
-            print("Transaction "+
-                  transaction.data.to_json()+
-                  " not accepted: "+", ".join(message))
+            logging.info("Transaction %s not accepted: %s\n",
+                         transaction.data.get("id"), ", ".join(message))
         return result
 
+    def reject(self, transaction, failure_code, failure_message):
+        """Marks a transaction as not settled, and why"""
+        transaction.data["failure_code"] = failure_code
+        transaction.data["failure_message"] = failure_message
+        self.unsettled.append(transaction)
+
     @classmethod
     def settle(cls, transactions):
         """
-            Checks a single transaction and adds a settlement id if OK
-            This should use the persistent store to verify settlements,
-            log the completed ones, and remove the transactions from the
-            pending list.
+            Checks a batch of transactions and adds a settlement id to those that are OK
+            Each approval code must be outstanding in the datastore, issued for
+            the same transaction (id, amount, currency, card and merchant), and
+            appear only once in the batch. The whole batch is verified and
+            removed from the pending list in a single datastore operation, then
+            appended to the archive if there is one. Settled transactions are
+            the stored authorizations, not the data sent by the merchant.
+            If the archive cannot record the batch, it is put back in the datastore.
         """
         result = cls()
+        candidates = []
+        claims = {}
         for transaction in transactions:
-            print(transaction)
-            if CCSettlement.check_transaction(transaction=transaction,
-                                              g_list=["approved", "approval_code"],
-                                              c_list=["type", "valid"],
-                                              m_list=["name", "network_id"]):
-                # Check if the card IS valid and IS authorized
-                if "approved" in transaction.data and transaction.data["approved"] \
-                   and "approval_code" in transaction.data and transaction.data["approval_code"]:
-                    if result.settlement_id == "pending":
-                        result.settlement_id = "settle_" + str(uuid.uuid4())
-                    transaction.data["settlement_id"] = result.settlement_id
-                    result.transactions.append(transaction)
-                    datastore.settle(transaction.data["approval_code"])
-                else: # Did not pass the test
-                    result.unsettled.append(transaction)
+            if not CCSettlement.check_transaction(transaction=transaction,
+                                                  g_list=["approved", "approval_code"],
+                                                  c_list=["type", "valid"],
+                                                  m_list=["name", "network_id"]):
+                result.reject(transaction, SETTLE_INCOMPLETE,
+                              "Missing information for settlement")
+                continue
+            # Check if the card IS valid and IS authorized
+            approval_code = transaction.data["approval_code"]
+            if not transaction.data["approved"] or not approval_code:
+                result.reject(transaction, SETTLE_NOT_APPROVED, "Transaction is not approved")
+            elif approval_code in claims:
+                result.reject(transaction, SETTLE_DUPLICATE,
+                              "Approval code is repeated in the settlement batch")
             else:
-                result.unsettled.append(transaction)
+                claims[approval_code] = transaction.data
+                candidates.append(transaction)
+
+        settled, failures = datastore.settle_many(claims) if claims else ({}, {})
+
+        for transaction in candidates:
+            stored = settled.get(transaction.data["approval_code"])
+            if stored is not None:
+                if result.settlement_id == "pending":
+                    result.settlement_id = "settle_" + str(uuid.uuid4())
+                transaction = CCTransaction.from_dict(stored)
+                transaction.data["settlement_id"] = result.settlement_id
+                result.transactions.append(transaction)
+            else:
+                # settle_many said why, so rejects cost no further datastore locking
+                failure = failures[transaction.data["approval_code"]]
+                if failure == SETTLE_MISMATCH:
+                    result.reject(transaction, SETTLE_MISMATCH,
+                                  "Transaction does not match its authorization")
+                elif failure == SETTLE_EXPIRED:
+                    result.reject(transaction, SETTLE_EXPIRED, "Authorization expired")
+                elif cls.archive is not None and \
+                     cls.archive.is_settled(transaction.data["approval_code"]):
+                    result.reject(transaction, SETTLE_ALREADY_SETTLED,
+                                  "Transaction already settled")
+                else:
+                    result.reject(transaction, SETTLE_UNKNOWN, "No such unsettled transaction")
+        if cls.archive is not None and result.transactions:
+            try:
+                cls.archive.append(result)
+            except Exception as err:
+                # Whatever went wrong (disk, or data the archive cannot encode),
+                # the authorizations must not be lost from both places
+                logging.error("Settlement %s could not be archived: %r\n",
+                              result.settlement_id, err)
+                datastore.restore(list(settled.values()))
+                failed, result.transactions = result.transactions, []
+                result.settlement_id = "pending"
+                for transaction in failed:
+                    del transaction.data["settlement_id"]
+                    result.reject(transaction, SETTLE_NOT_RECORDED,
+                                  "Settlement could not be recorded; settle again")
         return result
 
-    def to_json(self):
-        """Returns the settlement object as a JSON string"""
+    @staticmethod
+    def merchant_of(transaction):
+        """Returns the merchant network_id of a transaction, or "" if it has none"""
+        merchant_data = transaction.data.get("merchant_data")
+        if isinstance(merchant_data, dict):
+            return str(merchant_data.get("network_id", ""))
+        return ""
+
+    @classmethod
+    def settle_by_merchant(cls, transactions):
+        """
+            Partitions a batch by merchant network_id and settles the partitions
+            one after another, so each merchant gets its own settlement id.
+            Settling is Python code under the datastore lock, so threads would
+            add overhead without shortening the wall-clock time.
+            Returns a list of (network_id, CCSettlement) sorted by network_id.
+        """
+        partitions = {}
+        duplicates = {}
+        seen = set()
+        # Duplicates are found across the whole batch first, so a repeated code
+        # is rejected wherever it appears, not settled in another partition
+        for transaction in transactions:
+            network_id = cls.merchant_of(transaction)
+            approval_code = transaction.data.get("approval_code")
+            if approval_code and approval_code in seen:
+                duplicates.setdefault(network_id, []).append(transaction)
+                partitions.setdefault(network_id, [])
+                continue
+            if approval_code:
+                seen.add(approval_code)
+            partitions.setdefault(network_id, []).append(transaction)
+
+        results = []
+        for network_id in sorted(partitions):
+            settlement = cls.settle(partitions[network_id])
+            for transaction in duplicates.get(network_id, []):
+                settlement.reject(transaction, SETTLE_DUPLICATE,
+                                  "Approval code is repeated in the settlement batch")
+            results.append((network_id, settlement))
+        return results
+
+    @classmethod
+    def merchant_settlements_to_dict(cls, results):
+        """Returns the result of settle_by_merchant as a dict"""
+        settlements = []
+        for network_id, settlement in results:
+            settlement_dict = {"network_id": network_id}
+            settlement_dict.update(settlement.to_dict())
+            settlements.append(settlement_dict)
+        return {"settlements": settlements}
+
+    @classmethod
+    def merchant_settlements_to_json(cls, results):
+        """Returns the result of settle_by_merchant as a JSON string"""
+        return json.dumps(cls.merchant_settlements_to_dict(results))
+
+    def to_dict(self):
+        """Returns the settlement object as a dict of plain data"""
         result = {
             "settlement_id": self.settlement_id,
             "transactions":  self.transactions,
@@ -118,7 +243,11 @@ class CCSettlement:
         result["unsettled"] = []
         for u in self.unsettled:
             result["unsettled"].append(u.data)
-        return json.dumps(result)
+        return result
+
+    def to_json(self):
+        """Returns the settlement object as a JSON string"""
+        return json.dumps(self.to_dict())
 
     @classmethod
     def from_json(cls, json_string):
@@ -22,12 +22,21 @@ import uuid
 import logging
 import validation_utilities
 
+from validation_rules import (RulePipeline, default_authorization_rules,
+                              default_validation_rules)
+
 
 class CCTransaction:
     """A simplified Credit Card transaction"""
 
     enableAuthorizationChecks = False # By default, disable
 
+    # Rule pipelines used by validate_transaction and authorize_transaction.
+    # Replace them with set_validation_rules / set_authorization_rules;
+    # the authorization rules are built on first use, as they load ccstore.
+    validation_pipeline = RulePipeline(default_validation_rules())
+    authorization_pipeline = None
+
     def __init__(self, name="", credit_card_string="", cvv_string="", exp_month=0,
                  exp_year=2000, currency="usd"):
         """Initialize a transaction object"""
@@ -42,6 +51,25 @@ class CCTransaction:
     def set_authorization_checks(value=True):
         CCTransaction.enableAuthorizationChecks = value
 
+    @classmethod
+    def set_validation_rules(cls, rules):
+        """Replaces the validation rules; they run in the order given"""
+        cls.validation_pipeline = RulePipeline(rules)
+
+    @classmethod
+    def set_authorization_rules(cls, rules):
+        """Replaces the authorization rules; they run in the order given"""
+        cls.authorization_pipeline = RulePipeline(rules)
+
+    @classmethod
+    def rule_stats(cls):
+        """Returns the per-rule counters of both pipelines"""
+        return {
+            "validation": cls.validation_pipeline.stats(),
+            "authorization": cls.authorization_pipeline.stats()
+                             if cls.authorization_pipeline else []
+        }
+
     def set_amount(self, amount, currency="usd"):
         """sets the amount of the transaction in cents"""
         self.data["amount"] = int(amount)
@@ -179,34 +207,14 @@ class CCTransaction:
         that merchant information is provided,
         that the transaction amount is below a fixed limit,
         and that the expiration date provided is sensible.
+        The checks are the rules of CCTransaction.validation_pipeline.
         """
-        status = True
-        if not self.validate_card():
-            self.data["approved"] = False
-            self.data["failure_code"] = 401
-            self.data["failure_message"] = "Card is not valid"
-            status = False
-        elif not self.is_ready_for_request():
-            self.data["approved"] = False
-            self.data["failure_code"] = 402
-            self.data["failure_message"] = "Missing information for transaction approval"
-            status = False
-        elif int(self.data["amount"]) < 0 or int(self.data["amount"]) > 500000:
-            self.data["approved"] = False
-            self.data["failure_code"] = 405
-            self.data["failure_message"] = "Transaction amount threshold exceeded"
-            status = False
-        elif not self.validate_date():
-            self.data["approved"] = False
-            self.data["failure_code"] = 408
-            self.data["failure_message"] = "Invalid expiration date"
-            status = False
-        else:
-            self.data["approved"] = True
-            self.data["failure_code"] = ''
-            self.data["failure_message"] = ''
-            # self.data["approval_code"] = "tmpappr_" + str(uuid.uuid4())
-        return status
+        if CCTransaction.validation_pipeline.run(self.data) is not None:
+            return False
+        self.data["approved"] = True
+        self.data["failure_code"] = ''
+        self.data["failure_message"] = ''
+        return True
 
     def authorize_transaction(self):
         """
@@ -214,35 +222,15 @@ class CCTransaction:
         the information matches the card
         It would also verify the merchant is legitimate and the information matches the merchant.
         Other checks might also occur to prevent fraud.
+        The checks are the rules of CCTransaction.authorization_pipeline.
         """
-        from ccstore import cc_enrolled, cc_get_customer_id, cc_check_code, cc_get_limit
-        status = True
         # Shortcut out if individual accounts are not enabled.
-        if not CCTransaction.enableAuthorizationChecks:
-            self.data["authorized"] = True
-            self.data["approval_code"] = "appr_" + str(uuid.uuid4())
-            return status
-        card_id = self.data["card"]["id"]
-        if cc_enrolled(card_id):
-            customer_id = cc_get_customer_id(card_id)
-            if (cc_check_code(customer_id,self.data["card"]["card_code"])):
-                limit = cc_get_limit(customer_id)
-                if int(self.data["amount"] < int(limit)):
-                    self.data["authorized"] = True
-                    self.data["approval_code"] = "appr_" + str(uuid.uuid4())
-                else:
-                    self.data["authorized"] = False
-                    self.data["failure_code"] = 405
-                    self.data["failure_message"] = "Account threshold exceeded"
-                    status = False
-            else:
-                self.data["authorized"] = False
-                self.data["failure_code"] = 411
-                self.data["failure_message"] = "Card code incorrect"
-                status = False
-        else:
-            self.data["authorized"] = False
-            self.data["failure_code"] = 401
-            self.data["failure_message"] = "Credit card account not found"
-            status = False
-        return status
+        if CCTransaction.enableAuthorizationChecks:
+            if CCTransaction.authorization_pipeline is None:
+                CCTransaction.authorization_pipeline = \
+                    RulePipeline(default_authorization_rules())
+            if CCTransaction.authorization_pipeline.run(self.data) is not None:
+                return False
+        self.data["authorized"] = True
+        self.data["approval_code"] = "appr_" + str(uuid.uuid4())
+        return True
@@ -15,40 +15,258 @@ One way To generate a key file for the service is to use openssl:
     openssl req -new -x509 -keyout localhost.pem -out localhost.pem -days 365 -nodes
 
 """
+import atexit
 import json
 import logging
+import math
 import ssl
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 
 import datastore
+import http_encoding
+import wire_format
 
 from cc_settlement import CCSettlement
 from cc_transaction import CCTransaction
+from rate_limit import AdmissionController, TokenBucketLimiter
+from settlement_archive import SettlementArchive
+from settlement_scheduler import SettlementScheduler
+from traffic_capture import TrafficCapture
+from validation_rules import default_authorization_rules
+from velocity import VelocityLimit, VelocityTracker, velocity_rules
 
 # A few constants to allow easy modification
 cc_validation_port = 8000
 cc_validation_port_ssl = 8443
 cc_content_type_error = "text/html"
 cc_content_type_processor = "application/json"
+cc_tls_pem_file = "localhost.pem"
+cc_tls_handshake_timeout = 5     # seconds a client may take to complete the TLS handshake
+cc_tls_session_tickets = 2       # TLS 1.3 resumption tickets issued per connection
+cc_keep_alive_timeout = 30       # seconds an idle keep-alive connection is held open
+# Auto-settlement (replaces settle_remaining.sh); an interval of 0 and a threshold of 0 disable it
+cc_auto_settle_interval = 0      # seconds between sweeps of the unsettled store
+cc_auto_settle_threshold = 0     # sweep early once this many transactions are unsettled
+cc_auto_settle_chunk = 1000      # most transactions settled per chunk
+cc_auto_settle_max_load = 4      # back off while more requests than this are in flight
+# Settled transactions are appended here; None disables the archive
+cc_settlement_archive_dir = "settlements"
+# Admission control: requests beyond cc_max_in_flight get 503 at once; 0 is unbounded
+cc_max_in_flight = 64
+cc_max_body = 64 * 1024 * 1024   # largest request body accepted, after decompression
+cc_compress_min_size = 1024      # smaller responses are not worth compressing
+cc_retry_after = 1               # seconds, sent with 503 responses
+# Authorizations not settled within their time-to-live are dropped from the store
+cc_auth_ttl = 7 * 24 * 3600      # seconds; 0 never expires
+cc_auth_ttl_by_currency = {}     # currency -> seconds, e.g. {"jpy": 30 * 24 * 3600}
+cc_auth_ttl_by_merchant = {}     # merchant network_id -> seconds; overrides the currency
+cc_auth_expiry_tick = 1.0        # resolution of the expiry timing wheel, in seconds
+cc_auth_expired_kept = 100000    # expired approval codes remembered, so settle can say so
+# Traffic capture for replay.py; card data is tokenized with the key
+cc_capture_file = ""             # e.g. "capture.jsonl.gz"; "" does not capture
+cc_capture_token_key = ""        # "" uses a random key, so tokens match only within a capture
+# /api/store/events
+cc_event_log_size = 10000        # store changes kept for clients resuming from a cursor
+cc_max_event_streams = 16        # event streams and long polls held open at once
+cc_events_max_wait = 25          # seconds a long poll waits for a change
+cc_events_heartbeat = 15         # seconds between keep-alive comments on an idle stream
+cc_events_batch = 500            # most events sent at once
+# Per-merchant token buckets for /api/validate (transactions per second, burst); a rate of 0 disables
+cc_merchant_rate = 200
+cc_merchant_burst = 400
+# Velocity limits: (window seconds, max authorizations, max amount); None is unlimited.
+# Empty lists disable the velocity checks.
+cc_velocity_card_limits = [(1, 20, None), (60, 200, None)]
+cc_velocity_merchant_limits = [(1, 1000, None)]
+
+def make_tls_context(pem_file=cc_tls_pem_file):
+    """
+    Builds the server TLS context.
+    One context is kept for the life of the listener so its session cache and
+    ticket keys survive between connections, letting clients resume sessions
+    (an abbreviated handshake) instead of paying for a full one on every connection.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(pem_file, pem_file)
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = cc_tls_session_tickets
+    return context
+
+class TLSHTTPServer(ThreadingHTTPServer):
+    """
+    HTTPS server that performs the TLS handshake on the connection's own thread.
+
+    Wrapping the listening socket would do the handshake inside accept(),
+    so one slow or stalled client would hold up every other HTTPS merchant.
+    Here accept() returns the plain socket; the handshake happens on the
+    connection thread and is abandoned after handshake_timeout seconds.
+    """
+    handshake_timeout = cc_tls_handshake_timeout
+
+    def __init__(self, server_address, handler_class, context):
+        self.context = context
+        ThreadingHTTPServer.__init__(self, server_address, handler_class)
+
+    def finish_request(self, request, client_address):
+        request.settimeout(self.handshake_timeout)
+        try:
+            connection = self.context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError) as err:
+            logging.warning("TLS handshake with %s failed: %s\n", client_address[0], err)
+            request.close()
+            return
+        try:
+            connection.settimeout(None)
+            self.RequestHandlerClass(connection, client_address, self)
+        finally:
+            connection.close()
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
     """Request handling class"""
 
 
-    def _set_response(self, content_type=cc_content_type_processor):
-        """Sends additional headers and marks the response as ready to send the body."""
+    # HTTP/1.1 keeps connections alive between requests, so pooled clients
+    # do not pay for a new connection per transaction.
+    # Every response must therefore carry a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; do not let Nagle hold the body back
+    disable_nagle_algorithm = True
+    # Idle keep-alive connections are closed rather than holding a thread forever
+    timeout = cc_keep_alive_timeout
+
+    # POST requests being processed, across both listeners
+    admission = AdmissionController(cc_max_in_flight)
+    # Event streams and long polls on /api/store/events; they hold a thread each
+    event_streams = AdmissionController(cc_max_event_streams)
+    # Token buckets keyed on merchant network_id (or client address)
+    merchant_limiter = TokenBucketLimiter(cc_merchant_rate, cc_merchant_burst)
+    # The SettlementScheduler, if auto-settlement is enabled
+    scheduler = None
+    # A TrafficCapture recording POST requests, if capture is enabled
+    capture = None
+    # The request body read and the response sent, kept for the capture
+    _request_body = None
+    _response = None
+
+    @classmethod
+    def load(cls):
+        """Returns the number of POST requests being processed"""
+        return cls.admission.in_flight
+
+    def _set_response(self, content_type=cc_content_type_processor, content_length=0,
+                      content_encoding=None):
+        """
+        Sends additional headers and marks the response as ready to send the body.
+        A content_length of None sends the body chunked.
+        """
         self.send_response(200)
         self.send_header('Content-type', content_type)
+        if content_length is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(content_length))
+        if content_encoding:
+            self.send_header('Content-Encoding', content_encoding)
+        self.send_header('Vary', 'Accept-Encoding')
         self.send_header('Access-Control-Allow-Origin', "*")
         self.end_headers()
 
-    def _set_error(self, code, message):
+    def _send_body(self, body, content_type=cc_content_type_processor):
+        """
+        Sends a complete 200 response.
+        body is a str or bytes, or an iterable of str pieces (e.g. JSONEncoder.iterencode)
+        that is streamed chunked. Bodies of cc_compress_min_size or more are gzip-compressed,
+        a block at a time, if the client accepts it.
+        """
+        if self.capture is not None:
+            self._response = (200, content_type, body if isinstance(body, (str, bytes)) else None)
+        chunked_ok = self.request_version == "HTTP/1.1"
+        if isinstance(body, (str, bytes)):
+            payload = body.encode('utf-8') if isinstance(body, str) else body
+            if len(payload) < cc_compress_min_size or not chunked_ok or \
+               not http_encoding.accepts_gzip(self.headers):
+                self._set_response(content_type, len(payload))
+                self.wfile.write(payload)
+                return
+            body = [payload]
+        elif not chunked_ok:
+            self._send_body("".join(body), content_type)
+            return
+        if http_encoding.accepts_gzip(self.headers):
+            self._set_response(content_type, None, 'gzip')
+            http_encoding.write_gzip_chunked(self.wfile, body)
+        else:
+            self._set_response(content_type, None)
+            http_encoding.write_chunked(self.wfile, body)
+
+    def _read_raw_body(self):
+        """Reads the request body as bytes (see _read_body)"""
+        self._request_body = http_encoding.read_body(self.rfile, self.headers, cc_max_body)
+        return self._request_body
+
+    def _read_body(self):
+        """
+        Reads the request body as a string
+        The body may be sent with a Content-Length or chunked, and may be gzip-compressed.
+        Raises http_encoding.BodyError if it cannot be read.
+        """
+        post_data = self._read_raw_body()
+        try:
+            return post_data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise http_encoding.BodyError(400, "Request body is not UTF-8")
+
+    def _read_request(self):
+        """
+        Reads and decodes the request body: MessagePack if the Content-Type says so,
+        otherwise JSON. Raises http_encoding.BodyError if it cannot be decoded.
+        """
+        if wire_format.is_msgpack(self.headers.get('Content-Type')):
+            post_data = self._read_raw_body()
+            logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody: %d bytes of MessagePack\n",
+                         str(self.path), str(self.headers), len(post_data))
+            try:
+                return wire_format.unpackb(post_data)
+            except ValueError:
+                raise http_encoding.BodyError(400, "Request body is not valid MessagePack")
+        data_content = self._read_body()
+        logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
+                     str(self.path), str(self.headers), data_content)
+        try:
+            return json.loads(data_content)
+        except ValueError:
+            raise http_encoding.BodyError(400, "Request body is not JSON")
+
+    def _send_data(self, data, json_body=None):
+        """
+        Sends data as MessagePack if the request's Accept asks for it, otherwise as JSON.
+        json_body, if given, is the JSON to send (a string or iterencode pieces).
+        """
+        if wire_format.is_msgpack(self.headers.get('Accept')):
+            self._send_body(wire_format.packb(data), wire_format.CONTENT_TYPE)
+        elif json_body is not None:
+            self._send_body(json_body)
+        else:
+            self._send_body(json.dumps(data))
+
+    def _set_error(self, code, message, retry_after=None):
         """Sends additional headers and marks the response as ready to send the body."""
+        payload = message.encode('utf-8')
+        if self.capture is not None:
+            self._response = (code, cc_content_type_error, message)
+        # The request body may not have been read; do not reuse the connection
+        self.close_connection = True
         self.send_response(code)
         self.send_header('Content-type', cc_content_type_error)
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Connection', 'close')
+        if retry_after is not None:
+            self.send_header('Retry-After', str(max(1, math.ceil(retry_after))))
         self.end_headers()
-        self.wfile.write(message.encode('utf-8'))
+        self.wfile.write(payload)
 
     # pre-flight
     def do_OPTIONS(self):
@@ -56,6 +274,7 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, HEAD, OPTIONS')
         self.send_header("Access-Control-Allow-Headers", "*")
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
     def do_GET(self):
@@ -67,8 +286,22 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         logging.info("GET request,\nPath: %s\nHeaders:\n%s\n",
                      str(self.path), str(self.headers))
         if self.path.startswith("/hello"):
-            self._set_response('text/html')
-            self.wfile.write("<h3>Hello!</h3>\n".encode('utf-8'))
+            self._send_body("<h3>Hello!</h3>\n", 'text/html')
+            return
+        elif self.path == "/api/rules":
+            self._send_body(json.dumps(CCTransaction.rule_stats()))
+            return
+        elif self.path.startswith("/api/store/events"):
+            self.do_GET_store_events()
+            return
+        elif self.path == "/api/store/expiry":
+            self._send_body(json.dumps(datastore.expiry_stats()))
+            return
+        elif self.path == "/api/scheduler":
+            if self.scheduler is None:
+                self._send_body(json.dumps({"state": "disabled"}))
+            else:
+                self._send_body(json.dumps(self.scheduler.status()))
             return
         elif not self.path.startswith("/api/validate"):
             self._set_error(404, "<p>Invalid path "+str(self.path))
@@ -81,33 +314,142 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                       str(self.path), str(self.headers))
         return
 
+    _EVENT_FIELDS = ("sequence", "type", "approval_code", "amount", "currency",
+                     "network_id", "size")
+
+    @classmethod
+    def _event_dict(cls, event):
+        """A datastore event tuple as a dict, leaving out the fields it does not have"""
+        return {name: value for name, value in zip(cls._EVENT_FIELDS, event)
+                if value is not None}
+
+    @staticmethod
+    def _snapshot_dict(with_keys):
+        sequence, keys = datastore.snapshot()
+        result = {"sequence": sequence, "size": len(keys)}
+        if with_keys:
+            result["keys"] = keys
+        return result
+
+    def do_GET_store_events(self):
+        """
+        Follows changes to the unsettled store from a cursor (a sequence number).
+        Accept: text/event-stream gets a server-sent event stream; anything
+        else gets a JSON long poll. See README.md.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        cursor = self.headers.get('Last-Event-ID') or query.get("cursor", [None])[0]
+        try:
+            cursor = None if cursor is None else int(cursor)
+            wait = min(float(query.get("timeout", [cc_events_max_wait])[0]), cc_events_max_wait)
+        except ValueError:
+            self._set_error(400, "<p>cursor and timeout must be numbers<p>")
+            return
+        with_keys = query.get("keys", ["1"])[0].lower() not in ("0", "false", "no")
+
+        if not self.event_streams.try_enter():
+            self._set_error(503, "<p>Too many event streams<p>", retry_after=cc_retry_after)
+            return
+        try:
+            if "text/event-stream" in self.headers.get('Accept', ""):
+                self._stream_store_events(cursor, with_keys)
+            else:
+                self._poll_store_events(cursor, max(wait, 0), with_keys)
+        finally:
+            self.event_streams.leave()
+
+    def _poll_store_events(self, cursor, wait, with_keys):
+        """
+        Answers with the changes after cursor, waiting up to wait seconds for one.
+        Without a cursor, or with one too old to resume from, the answer is
+        a snapshot of the store and "reset" is true.
+        """
+        reset, events = (True, []) if cursor is None else \
+            datastore.events_since(cursor, wait, cc_events_batch)
+        if reset:
+            response = self._snapshot_dict(with_keys)
+            response.update({"reset": True, "events": []})
+        else:
+            response = {
+                "sequence": events[-1][0] if events else cursor,
+                "reset": False,
+                "events": [self._event_dict(event) for event in events]
+            }
+        self._send_body(json.dumps(response))
+
+    def _stream_store_events(self, cursor, with_keys):
+        """
+        Sends store changes as server-sent events until the client goes away.
+        The stream starts with a "snapshot" event unless the cursor (Last-Event-ID)
+        can be resumed from; each event's id is its sequence number.
+        """
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Access-Control-Allow-Origin', "*")
+        self.end_headers()
+
+        def send(text):
+            http_encoding.write_chunk(self.wfile, text.encode('utf-8'))
+
+        try:
+            send("retry: 1000\n\n")
+            reset = cursor is None
+            while True:
+                if reset:
+                    snapshot = self._snapshot_dict(with_keys)
+                    cursor = snapshot["sequence"]
+                    send("id: %d\nevent: snapshot\ndata: %s\n\n" % (cursor, json.dumps(snapshot)))
+                reset, events = datastore.events_since(cursor, cc_events_heartbeat,
+                                                       cc_events_batch)
+                if events:
+                    send("".join("id: %d\nevent: %s\ndata: %s\n\n" %
+                                 (event[0], event[1], json.dumps(self._event_dict(event)))
+                                 for event in events))
+                    cursor = events[-1][0]
+                elif not reset:
+                    send(": keep-alive\n\n")
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            logging.info("Event stream to %s closed\n", self.client_address[0])
+
     def do_POST_store(self):
-        import json
         """Dumps the current list of unsettled transactions"""
-        content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
-        post_data = self.rfile.read(content_length)  # <--- Gets the data itself
-        data_content = post_data.decode('utf-8')
-        logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
-                     str(self.path), str(self.headers), data_content)
-        self._set_response()
         verbose = False
         try:
-            if isinstance(data_content, dict):
-                req = data_content
-            elif isinstance(data_content, str):
-                req = json.loads(data_content)
-                if isinstance(req,dict):
-                    if "verbose" in req:
-                        verbose = req["verbose"]
-        except:
-            pass
+            req = self._read_request()
+            if isinstance(req,dict):
+                if "verbose" in req:
+                    verbose = req["verbose"]
+        except http_encoding.BodyError as err:
+            # An undecodable body just means the default listing
+            if err.code != 400:
+                raise
 
         if verbose:
             settlement = datastore.get_unsettled()
-            self.wfile.write(json.dumps(settlement).encode())
+            self._send_data(settlement, json.JSONEncoder().iterencode(settlement))
         else:
             settlement_ids = datastore.get_unsettled_keys()
-            self.wfile.write(json.dumps(settlement_ids).encode())
+            self._send_data(settlement_ids)
+
+    @staticmethod
+    def _check_transactions(transactions):
+        """Raises BodyError (400) unless every transaction is an object"""
+        for position, transaction in enumerate(transactions):
+            if not isinstance(transaction, dict):
+                raise http_encoding.BodyError(400, "Transaction %d is not an object" % position)
+
+    def _read_transaction_list(self):
+        """Reads a request that must be a list of transactions"""
+        request = self._read_request()
+        if not isinstance(request, list):
+            raise http_encoding.BodyError(400, "Expected a list of transactions")
+        self._check_transactions(request)
+        transaction_list = [CCTransaction.from_dict(t) for t in request]
+        logging.info("POST request: Transactions: %d\n", len(transaction_list))
+        return transaction_list
 
     def do_POST_settle(self):
         """
@@ -115,38 +457,108 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         Only previously approved transactions can be settled, and only once.
 
         """
-        self._set_response()
-        content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
-        post_data = self.rfile.read(content_length)  # <--- Gets the data itself
-        data_content = post_data.decode('utf-8')
-        logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
-                     str(self.path), str(self.headers), data_content)
         # Content is a list of transactions to settle.
         # Return a settlement object
-        transaction_list = CCTransaction.json_to_list(data_content)
-        logging.info("POST request: Transactions: %d\n", len(transaction_list))
+        transaction_list = self._read_transaction_list()
         settlement = CCSettlement.settle(transaction_list)
-        self.wfile.write(settlement.to_json().encode())
+        self._send_data(settlement.to_dict())
 
-    def do_POST_validate(self):
-        """Handle the validation request"""
-        content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
-        post_data = self.rfile.read(content_length)  # <--- Gets the data itself
-        data_content = post_data.decode('utf-8')
+    def do_POST_settle_merchants(self):
+        """
+        Handles POST request for settlement partitioned by merchant
+        The input is the same as /api/settle; each merchant network_id in the batch
+        is settled under its own settlement id.
+        """
+        transaction_list = self._read_transaction_list()
+        results = CCSettlement.settle_by_merchant(transaction_list)
+        self._send_data(CCSettlement.merchant_settlements_to_dict(results))
 
+    def do_POST_settlement(self):
+        """
+        Looks up settled transactions in the archive
+        Input is one of {"settlement_id": id}, {"approval_code": code} or {"date": "YYYY-MM-DD"}
+        Output is a list of settled transactions
+        """
+        data_content = self._read_body()
         logging.info("POST request,\nPath: %s\nHeaders:\n%s\n\nBody:\n%s\n",
                      str(self.path), str(self.headers), data_content)
+        archive = CCSettlement.archive
+        if archive is None:
+            self._set_error(501, "<p>The settlement archive is not enabled<p>")
+            return
+        try:
+            req = json.loads(data_content)
+        except ValueError:
+            req = None
+        if not isinstance(req, dict):
+            self._set_error(400, "<p>Expected settlement_id, approval_code or date<p>")
+        elif "settlement_id" in req:
+            self._send_body(archive.settlement_json(str(req["settlement_id"])))
+        elif "approval_code" in req:
+            transaction = archive.lookup_approval(str(req["approval_code"]))
+            self._send_body(json.dumps([transaction] if transaction else []))
+        elif "date" in req:
+            self._send_body(archive.export_day_json(str(req["date"])))
+        else:
+            self._set_error(400, "<p>Expected settlement_id, approval_code or date<p>")
 
-        # Here we'll take up the data to respond with and send it back to the caller.
-        cc = CCTransaction.from_json(data_content)
+    @staticmethod
+    def _validate(cc):
+        """Validates and authorizes one transaction, storing it if approved"""
         if cc.validate_transaction():
             if cc.authorize_transaction():
                 # Should store be restricted to approvals? Or let the store qualify them?
                 datastore.store(cc.data) # <- Set the transaction in an unsettled store
-        logging.info("Validation response: %s\n", cc.to_json())
-        self._set_response()
+        return cc
+
+    def _merchant_counts(self, transactions):
+        """
+        Counts the transactions per merchant bucket (keyed on
+        merchant_data.network_id, or on the client address without one)
+        """
+        counts = {}
+        for transaction in transactions:
+            key = None
+            if isinstance(transaction, dict) and isinstance(transaction.get("merchant_data"), dict):
+                key = transaction["merchant_data"].get("network_id")
+            if key is None:
+                key = "client:" + self.client_address[0]
+            key = str(key)
+            counts[key] = counts.get(key, 0) + 1
+        return counts
 
-        self.wfile.write(cc.to_json().encode())
+    def do_POST_validate(self):
+        """
+        Handle the validation request
+        The body is a single transaction, or a list of transactions
+        (a micro-batch) that is answered with a list in the same order.
+        """
+        request = self._read_request()
+        transactions = request if isinstance(request, list) else [request]
+        self._check_transactions(transactions)
+
+        # Charge each merchant's token bucket before any validation work:
+        # a token per transaction, from every bucket or from none
+        counts = self._merchant_counts(transactions)
+        if any(self.merchant_limiter.too_large(count) for count in counts.values()):
+            self._set_error(413, "<p>More transactions for one merchant than its burst of "
+                            "%d; split the batch<p>" % self.merchant_limiter.burst)
+            return
+        wait = self.merchant_limiter.acquire_many(counts)
+        if wait:
+            self._set_error(429, "<p>Merchant request rate exceeded<p>", retry_after=wait)
+            return
+
+        # Here we'll take up the data to respond with and send it back to the caller.
+        if isinstance(request, list):
+            transaction_list = [CCTransaction.from_dict(t) for t in request]
+            response = [self._validate(cc).data for cc in transaction_list]
+        else:
+            cc = CCTransaction()
+            cc.data = request
+            response = self._validate(cc).data
+        logging.info("Validation response: %s\n", response)
+        self._send_data(response)
 
     def do_POST(self):
         """
@@ -160,12 +572,44 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         called the Content-Length. It is a required part of the HTTP standard so it may
         be relied upon to be present.
         """
+        if self.capture is None:
+            self._handle_POST()
+            return
+        arrival = time.time()
+        started = time.perf_counter()
+        self._request_body = None
+        self._response = None
+        try:
+            self._handle_POST()
+        finally:
+            status, content_type, body = self._response or (None, None, None)
+            self.capture.record(arrival, time.perf_counter() - started, "POST", self.path,
+                                self.headers, self._request_body, status, content_type, body)
+
+    def _handle_POST(self):
+        # Refuse at once rather than queue behind a saturated service
+        if not self.admission.try_enter():
+            self._set_error(503, "<p>Service busy<p>", retry_after=cc_retry_after)
+            return
+        try:
+            self._route_POST()
+        except http_encoding.BodyError as err:
+            self._set_error(err.code, "<p>" + err.message + "<p>")
+        finally:
+            self.admission.leave()
+
+    def _route_POST(self):
+        """Dispatches a POST request by path"""
         if self.path == "/api/validate":
             self.do_POST_validate()
         elif self.path == "/api/settle":
             self.do_POST_settle()
+        elif self.path == "/api/settle/merchants":
+            self.do_POST_settle_merchants()
         elif self.path == "/api/store":
             self.do_POST_store()
+        elif self.path == "/api/settlement":
+            self.do_POST_settlement()
         else:
             self._set_error(404, "<p>Invalid path "+str(self.path))
             logging.error("POST request,\nPath: %s\nHeaders:\n%s\n\n",
@@ -189,14 +633,19 @@ def run(server_class=HTTPServer, handler_class=HTTPRequestHandler,
     """
     logging.basicConfig(level=logging.INFO)
     server_address = ('', port)
-    httpd = server_class(server_address, handler_class)
 
     ### TLS
     if use_ssl:
         logging.info("    Wrapping HTTP with TLS on port " + str(port) + "\n")
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain('localhost.pem', 'localhost.pem')
-        httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+        context = make_tls_context(cc_tls_pem_file)
+        if issubclass(server_class, TLSHTTPServer):
+            httpd = server_class(server_address, handler_class, context)
+        else:
+            # Handshakes happen in accept(), on the serving thread
+            httpd = server_class(server_address, handler_class)
+            httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+    else:
+        httpd = server_class(server_address, handler_class)
     ### END TLS
 
     logging.info('Starting httpd... on port ' + str(port) + "\n")
@@ -210,22 +659,62 @@ def run(server_class=HTTPServer, handler_class=HTTPRequestHandler,
     logging.info('Stopping httpd...\n')
 
 
+def auth_ttl(transaction):
+    """Seconds an authorization may wait for settlement: by merchant, then currency"""
+    merchant_data = transaction.get("merchant_data")
+    if isinstance(merchant_data, dict) and \
+       merchant_data.get("network_id") in cc_auth_ttl_by_merchant:
+        return cc_auth_ttl_by_merchant[merchant_data["network_id"]]
+    currency = str(transaction.get("currency", "")).lower()
+    return cc_auth_ttl_by_currency.get(currency, cc_auth_ttl)
+
 if __name__ == '__main__':
 
     # Set the server to enable or disable
     # specific account checking in the validation service:
     CCTransaction.enableAuthorizationChecks = True
 
+    if cc_velocity_card_limits or cc_velocity_merchant_limits:
+        tracker = VelocityTracker([VelocityLimit(*limit) for limit in cc_velocity_card_limits],
+                                  [VelocityLimit(*limit) for limit in cc_velocity_merchant_limits])
+        CCTransaction.set_authorization_rules(default_authorization_rules() +
+                                              velocity_rules(tracker))
+
+    # A keep-alive connection holds its handler until the client closes it,
+    # so each connection gets its own thread.
     httpd_http = threading.Thread(group=None, target=run, name="http",
-                                  kwargs={"server_class": HTTPServer,
+                                  kwargs={"server_class": ThreadingHTTPServer,
                                           "handler_class": HTTPRequestHandler,
                                           "port": cc_validation_port,
                                           "use_ssl": False})
     httpd_https = threading.Thread(group=None, target=run, name="https",
-                                   kwargs={"server_class": HTTPServer,
+                                   kwargs={"server_class": TLSHTTPServer,
                                            "handler_class": HTTPRequestHandler,
                                            "port": cc_validation_port_ssl,
                                            "use_ssl": True})
 
+    datastore.set_event_log_size(cc_event_log_size)
+    if cc_capture_file:
+        HTTPRequestHandler.capture = TrafficCapture(cc_capture_file,
+                                                    cc_capture_token_key or None)
+        atexit.register(HTTPRequestHandler.capture.close)
+    if cc_auth_ttl or cc_auth_ttl_by_currency or cc_auth_ttl_by_merchant:
+        datastore.set_expiry(auth_ttl, tick=cc_auth_expiry_tick,
+                             tombstones=cc_auth_expired_kept)
+
+    if cc_settlement_archive_dir:
+        CCSettlement.archive = SettlementArchive(cc_settlement_archive_dir)
+
+    if cc_auto_settle_interval or cc_auto_settle_threshold:
+        HTTPRequestHandler.scheduler = SettlementScheduler(
+            interval=cc_auto_settle_interval, size_threshold=cc_auto_settle_threshold,
+            chunk_size=cc_auto_settle_chunk, load=HTTPRequestHandler.load,
+            max_load=cc_auto_settle_max_load)
+        HTTPRequestHandler.scheduler.start()
+
     httpd_http.start()
     httpd_https.start()
+    # The main thread waits on the listeners: once it returns, the interpreter
+    # starts shutting down while they are still serving
+    httpd_http.join()
+    httpd_https.join()
@@ -5,14 +5,131 @@
    The intent is for all unsettled transactions to be stored in it.
    A persistent version would back it up to and restore from a file or redis
    This could be the guts of a class if multiples stores are needed
+
+   The service handles each connection on its own thread,
+   so every access goes through _LOCK.
+
+   Every change is also appended to a bounded event log with a sequence number,
+   so a client can follow the store (events_since) instead of re-reading all of it.
+   Events are tuples (sequence, type, approval_code, amount, currency, network_id, size)
+   where type is "store", "settle" or "expire", size is the store size after the change,
+   and amount / currency / network_id are None for a settle or expire.
+
+   If set_expiry is called, each authorization expires a time-to-live after it
+   is stored. Deadlines are kept in a TimingWheel, which is advanced lazily by
+   the store operations, so expired entries are removed without scanning the store.
+   The most recent expired approval codes are remembered (tombstones) so that
+   settling one is reported as expired rather than unknown.
 """
+import collections
+import itertools
+import threading
+import time
+
+from timing_wheel import TimingWheel
+
+DEFAULT_EVENT_LOG_SIZE = 10000
+DEFAULT_TOMBSTONES = 100000
+UNKNOWN_FAILURE = 404
+EXPIRED_FAILURE = 412
+MISMATCH_FAILURE = 406
+
 _DATASTORE = {}
+_LOCK = threading.RLock()
+_CHANGED = threading.Condition(_LOCK)
+_EVENTS = collections.deque(maxlen=DEFAULT_EVENT_LOG_SIZE)
+_SEQUENCE = 0
+
+_WHEEL = None        # TimingWheel of approval codes, when authorizations expire
+_TTL_FOR = None      # transaction -> seconds to live, or None for no expiry
+_CLOCK = time.time
+_EXPIRED = collections.OrderedDict()   # tombstones: approval codes that expired
+_MAX_TOMBSTONES = DEFAULT_TOMBSTONES
+_EXPIRED_COUNT = 0
+
+def _record(kind, approval_code, transaction=None):
+    """Appends an event for a change just made; the caller holds _LOCK"""
+    global _SEQUENCE
+    _SEQUENCE += 1
+    if transaction is None:
+        _EVENTS.append((_SEQUENCE, kind, approval_code, None, None, None, len(_DATASTORE)))
+    else:
+        _EVENTS.append((_SEQUENCE, kind, approval_code, transaction.get("amount"),
+                        transaction.get("currency"), _network_id(transaction),
+                        len(_DATASTORE)))
+    _CHANGED.notify_all()
+
+def _expire_due():
+    """Removes the authorizations whose time is up; the caller holds _LOCK"""
+    global _EXPIRED_COUNT
+    if _WHEEL is None:
+        return
+    for approval_code in _WHEEL.advance(_CLOCK()):
+        if _DATASTORE.pop(approval_code, None) is None:
+            continue
+        _EXPIRED_COUNT += 1
+        _EXPIRED[approval_code] = True
+        if len(_EXPIRED) > _MAX_TOMBSTONES:
+            _EXPIRED.popitem(last=False)
+        _record("expire", approval_code)
+
+def _schedule(approval_code, transaction):
+    """Sets (or clears) the expiry of a stored authorization; the caller holds _LOCK"""
+    ttl = _TTL_FOR(transaction)
+    if ttl:
+        _WHEEL.schedule(approval_code, _CLOCK() + ttl)
+    else:
+        _WHEEL.cancel(approval_code)
+    _EXPIRED.pop(approval_code, None)
+
+def set_expiry(ttl_for, tick=1.0, tombstones=DEFAULT_TOMBSTONES, clock=time.time):
+    """
+    Expires each authorization ttl_for(transaction) seconds after it is stored
+    (a ttl of None or 0 never expires); ttl_for of None turns expiry off.
+    Deadlines are rounded up to tick seconds. The last `tombstones` expired
+    approval codes are remembered for settle to report.
+    """
+    global _WHEEL, _TTL_FOR, _CLOCK, _MAX_TOMBSTONES
+    with _LOCK:
+        _CLOCK = clock
+        _TTL_FOR = ttl_for
+        _MAX_TOMBSTONES = tombstones
+        if ttl_for is None:
+            _WHEEL = None
+            return
+        _WHEEL = TimingWheel(tick, now=clock())
+        for approval_code, transaction in _DATASTORE.items():
+            _schedule(approval_code, transaction)
+
+def expire():
+    """Removes expired authorizations now; returns the number removed"""
+    with _LOCK:
+        before = _EXPIRED_COUNT
+        _expire_due()
+        return _EXPIRED_COUNT - before
+
+def expiry_stats():
+    """Reports the expiry bookkeeping"""
+    with _LOCK:
+        _expire_due()
+        return {
+            "enabled": _WHEEL is not None,
+            "scheduled": len(_WHEEL) if _WHEEL is not None else 0,
+            "expired": _EXPIRED_COUNT,
+            "tombstones": len(_EXPIRED),
+            "unsettled": len(_DATASTORE),
+        }
 
 def store(transaction):
     """Stores transaction by approval_code"""
     result = True
     if "approval_code" in transaction:
-        _DATASTORE[transaction["approval_code"]] = transaction
+        with _LOCK:
+            _expire_due()
+            _DATASTORE[transaction["approval_code"]] = transaction
+            if _WHEEL is not None:
+                _schedule(transaction["approval_code"], transaction)
+            _record("store", transaction["approval_code"], transaction)
     else:
         print("Cannot store unapproved transaction")
         result = False
@@ -21,27 +138,141 @@ def store(transaction):
 
 def settle(approval_code):
     """Remove approved transaction once settled"""
-    if approval_code in _DATASTORE:
-        result = _DATASTORE[approval_code]
-        _DATASTORE.pop(approval_code, None)
-    else:
-        result = {"failure_code": 404, "failure_message": "No such unsettled transaction"}
+    with _LOCK:
+        _expire_due()
+        result = _DATASTORE.pop(approval_code, None)
+        if result is not None:
+            if _WHEEL is not None:
+                _WHEEL.cancel(approval_code)
+            _record("settle", approval_code)
+        elif approval_code in _EXPIRED:
+            result = {"failure_code": EXPIRED_FAILURE, "failure_message": "Authorization expired"}
+    if result is None:
+        result = {"failure_code": UNKNOWN_FAILURE, "failure_message": "No such unsettled transaction"}
     return result
 
+def _network_id(transaction):
+    merchant = transaction.get("merchant_data")
+    return merchant.get("network_id") if isinstance(merchant, dict) else None
+
+def _card_id(transaction):
+    card = transaction.get("card")
+    return card.get("id") if isinstance(card, dict) else None
+
+def _matches(stored, claimed):
+    """True if a claimed transaction is the one stored: same id, amount, currency, card and merchant"""
+    return (stored.get("id") == claimed.get("id") and
+            stored.get("amount") == claimed.get("amount") and
+            stored.get("currency") == claimed.get("currency") and
+            _card_id(stored) == _card_id(claimed) and
+            _network_id(stored) == _network_id(claimed))
+
+def settle_many(claims):
+    """
+    Removes a batch of approved transactions in one operation.
+    claims maps approval_code -> the transaction data sent for settlement; a claim
+    is honoured only if the code is outstanding and the stored transaction matches it.
+    Returns (settled, failures): a dict of approval_code -> stored transaction for
+    the settled claims, and of approval_code -> why each other claim was not:
+    MISMATCH_FAILURE (the stored transaction differs, and stays unsettled),
+    EXPIRED_FAILURE (a remembered expired code) or UNKNOWN_FAILURE.
+    """
+    settled = {}
+    failures = {}
+    with _LOCK:
+        _expire_due()
+        for approval_code, claimed in claims.items():
+            stored = _DATASTORE.get(approval_code)
+            if stored is None:
+                failures[approval_code] = EXPIRED_FAILURE if approval_code in _EXPIRED \
+                    else UNKNOWN_FAILURE
+                continue
+            if not _matches(stored, claimed):
+                failures[approval_code] = MISMATCH_FAILURE
+                continue
+            settled[approval_code] = _DATASTORE.pop(approval_code)
+            if _WHEEL is not None:
+                _WHEEL.cancel(approval_code)
+            _record("settle", approval_code)
+    return settled, failures
+
+def restore(transactions):
+    """
+    Puts back settled transactions whose settlement could not be recorded,
+    so they can be settled again; their time to live starts again.
+    """
+    with _LOCK:
+        for transaction in transactions:
+            approval_code = transaction["approval_code"]
+            _DATASTORE[approval_code] = transaction
+            if _WHEEL is not None:
+                _schedule(approval_code, transaction)
+            _record("store", approval_code, transaction)
+
 def size():
     """Return the number of items awaiting settlement"""
     return len(_DATASTORE)
 
 def get_unsettled_keys():
     """Returns a list of the keys of unsettled items"""
-    result = []
-    for key in _DATASTORE:
-        result.append(key)
-    return result
+    with _LOCK:
+        _expire_due()
+        return list(_DATASTORE)
 
-def get_unsettled():
-    """Returns the full transaction for unsettled items"""
-    result = []
-    for key in _DATASTORE:
-        result.append(_DATASTORE[key])
-    return result
+def get_unsettled(limit=None):
+    """Returns the full transaction for unsettled items, oldest first, at most limit of them"""
+    with _LOCK:
+        _expire_due()
+        if limit is None:
+            return list(_DATASTORE.values())
+        return list(itertools.islice(_DATASTORE.values(), limit))
+
+def sequence():
+    """Returns the sequence number of the latest change"""
+    return _SEQUENCE
+
+def snapshot():
+    """Returns (sequence, keys): the unsettled keys as of that sequence number"""
+    with _LOCK:
+        _expire_due()
+        return _SEQUENCE, list(_DATASTORE)
+
+def set_event_log_size(log_size):
+    """Keeps at most log_size events; older cursors are told to reset"""
+    global _EVENTS
+    with _LOCK:
+        _EVENTS = collections.deque(_EVENTS, maxlen=log_size)
+
+def events_since(cursor, timeout=None, limit=None):
+    """
+    Returns (reset, events) for the changes after sequence number cursor,
+    waiting up to timeout seconds for one if there are none yet (None waits forever).
+    Authorizations that have expired are removed first, so their events are included.
+    reset is True if the cursor is older than the event log (or newer than the
+    latest change, e.g. from before a restart); the client should re-read the
+    store with snapshot() and continue from its sequence number.
+    """
+    with _CHANGED:
+        _expire_due()
+        if cursor == _SEQUENCE and timeout != 0:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while _SEQUENCE == cursor:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    break
+                if _WHEEL is not None:
+                    # Wake each tick so expirations reach waiting clients
+                    wait = _WHEEL.tick if wait is None else min(wait, _WHEEL.tick)
+                _CHANGED.wait(wait)
+                _expire_due()
+        if cursor > _SEQUENCE:
+            return True, []
+        if cursor == _SEQUENCE:
+            return False, []
+        oldest = _EVENTS[0][0] if _EVENTS else _SEQUENCE + 1
+        if cursor < oldest - 1:
+            return True, []
+        # Sequence numbers are consecutive, so the cursor's position is known
+        start = cursor - oldest + 1
+        stop = len(_EVENTS) if limit is None else min(len(_EVENTS), start + limit)
+        return False, list(itertools.islice(_EVENTS, start, stop))
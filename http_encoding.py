@@ -0,0 +1,175 @@
+"""
+   Author: M I Schwartz
+
+   Request and response body encodings for the service's HTTP handler.
+
+   * read_body reads a request body sent with a Content-Length or with
+       Transfer-Encoding: chunked, and inflates Content-Encoding: gzip,
+       a block at a time, refusing bodies that grow past max_size
+   * accepts_gzip checks a request's Accept-Encoding
+   * write_chunked / write_gzip_chunked send a response as
+       Transfer-Encoding: chunked, compressing a block at a time,
+       so a large response is never held compressed in memory
+   * write_chunk / write_last_chunk send a chunked response piece by piece,
+       for responses that are produced over time (server-sent events)
+"""
+
+import zlib
+
+BLOCK_SIZE = 64 * 1024
+DEFAULT_MAX_BODY = 64 * 1024 * 1024
+GZIP_LEVEL = 6
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class BodyError(Exception):
+    """A request body that cannot be read; carries the HTTP status to answer with"""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def _read_chunked(rfile):
+    """Yields the data of a chunked request body"""
+    while True:
+        line = rfile.readline(1024)
+        if not line:
+            raise BodyError(400, "Truncated chunked body")
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise BodyError(400, "Malformed chunk size")
+        if size == 0:
+            # Skip any trailer fields up to the blank line
+            while rfile.readline(1024) not in (b"\r\n", b"\n", b""):
+                pass
+            return
+        while size > 0:
+            data = rfile.read(min(size, BLOCK_SIZE))
+            if not data:
+                raise BodyError(400, "Truncated chunked body")
+            size -= len(data)
+            yield data
+        rfile.readline(1024)   # the CRLF after the chunk data
+
+
+def _read_length(rfile, length):
+    """Yields the data of a body of known length"""
+    while length > 0:
+        data = rfile.read(min(length, BLOCK_SIZE))
+        if not data:
+            raise BodyError(400, "Truncated body")
+        length -= len(data)
+        yield data
+
+
+def read_body(rfile, headers, max_size=DEFAULT_MAX_BODY):
+    """Returns the decoded request body as bytes"""
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        blocks = _read_chunked(rfile)
+    elif headers.get("Content-Length") is not None:
+        try:
+            length = int(headers["Content-Length"])
+        except ValueError:
+            raise BodyError(400, "Malformed Content-Length")
+        blocks = _read_length(rfile, length)
+    else:
+        raise BodyError(411, "Content-Length or chunked Transfer-Encoding required")
+
+    encoding = headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        inflater = zlib.decompressobj(_GZIP_WBITS)
+    elif encoding == "identity":
+        inflater = None
+    else:
+        raise BodyError(415, "Unsupported Content-Encoding " + encoding)
+
+    body = []
+    size = 0
+    for block in blocks:
+        if inflater is not None:
+            try:
+                # Never inflate more than the remaining allowance at once
+                block = inflater.decompress(block, max_size - size + 1)
+                while inflater.unconsumed_tail and len(block) <= max_size - size:
+                    block += inflater.decompress(inflater.unconsumed_tail, max_size - size + 1)
+            except zlib.error:
+                raise BodyError(400, "Corrupt gzip body")
+        size += len(block)
+        if size > max_size:
+            raise BodyError(413, "Request body too large")
+        body.append(block)
+    if inflater is not None and not inflater.eof:
+        raise BodyError(400, "Truncated gzip body")
+    return b"".join(body)
+
+
+def accepts_gzip(headers):
+    """True if the request's Accept-Encoding allows gzip (and does not give it q=0)"""
+    for item in headers.get("Accept-Encoding", "").split(","):
+        name, _, params = item.partition(";")
+        if name.strip().lower() not in ("gzip", "x-gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        return quality > 0
+    return False
+
+
+def _blocks(pieces):
+    """
+    Coalesces small str pieces (e.g. from JSONEncoder.iterencode) into encoded blocks;
+    bytes pieces are passed through as they are.
+    """
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            if buffer:
+                yield "".join(buffer).encode("utf-8")
+                buffer = []
+                size = 0
+            yield piece
+            continue
+        buffer.append(piece)
+        size += len(piece)
+        if size >= BLOCK_SIZE:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def write_chunk(wfile, data):
+    """Writes one chunk of a chunked body (nothing for empty data, which would end it)"""
+    if data:
+        wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+
+def write_last_chunk(wfile):
+    wfile.write(b"0\r\n\r\n")
+
+
+def write_chunked(wfile, pieces):
+    """Writes str (or bytes) pieces as a chunked body"""
+    for block in _blocks(pieces):
+        write_chunk(wfile, block)
+    write_last_chunk(wfile)
+
+
+def write_gzip_chunked(wfile, pieces):
+    """Writes str (or bytes) pieces gzip-compressed as a chunked body"""
+    deflater = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    for block in _blocks(pieces):
+        write_chunk(wfile, deflater.compress(block))
+    write_chunk(wfile, deflater.flush())
+    write_last_chunk(wfile)
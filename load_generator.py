@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+   Author: M I Schwartz
+
+   Concurrent load generator and latency reporter for the
+   credit card validation service.
+
+   Worker threads each hold a pooled, keep-alive requests.Session and
+   drive /api/validate; approved transactions are collected per worker and
+   posted to /api/settle in batches.
+
+   The report gives throughput and p50/p95/p99/max latency per route.
+   With --rate, validate latency runs from each request's scheduled send
+   time, so when the server falls behind the queueing delay is counted.
+
+   The enrolled card book has only a few cards, so at full speed the
+   service's per-card velocity limits (cc_velocity_card_limits, 20 per
+   second by default) refuse most transactions with 421, and the run
+   measures the rejection path instead of capacity. For capacity runs,
+   start the service with cc_velocity_card_limits = [] (and
+   cc_velocity_merchant_limits = []). The report counts velocity refusals
+   separately and warns when they are more than a tenth of the validates.
+   With --sweep, the run is repeated at each concurrency level so the
+   saturation point of a server mode (http on 8000, https on 8443) shows
+   up as the level where throughput stops growing and latency climbs.
+
+   Usage::
+       python3 load_generator.py --concurrency 8 --duration 10
+       python3 load_generator.py --url https://localhost:8443 --insecure
+       python3 load_generator.py --rate 200 --settle-every 50
+       python3 load_generator.py --sweep 1,2,4,8,16,32 --json sweep.json
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+
+import requests
+
+from cc_transaction import CCTransaction
+from velocity import CARD_VELOCITY_FAILURE, MERCHANT_VELOCITY_FAILURE
+
+DEFAULT_URL = "http://localhost:8000"
+DEFAULT_CARDS_FILE = "enrolled_credit_cards.json"
+VELOCITY_WARNING = 0.1   # share of validates refused by velocity limits worth a warning
+
+# Used when no enrolled card file is available
+DEFAULT_CARDS = [
+    {"id": "4140-1233-3445-4561", "name": "ICT4310 Instructor", "card_code": "123",
+     "exp_month": "12", "exp_year": "2028", "currency": "usd"},
+]
+# A Luhn failure, for the --bad-ratio share of requests
+BAD_CARD = {"id": "4140-1233-3445-4560", "name": "ICT4310 Instructor", "card_code": "123",
+            "exp_month": "12", "exp_year": "2028", "currency": "usd"}
+
+
+def load_cards(filename):
+    """Returns the card mix: enrolled cards that are not expired, or the default card"""
+    try:
+        with open(filename) as f:
+            enrolled = json.load(f)
+    except (OSError, ValueError):
+        return DEFAULT_CARDS
+    today = datetime.date.today()
+    cards = [card for card in enrolled
+             if (int(card["exp_year"]), int(card["exp_month"])) > (today.year, today.month)]
+    return cards or DEFAULT_CARDS
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class RouteStats:
+    """Latencies and outcomes for one route"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.rejected = 0
+        self.velocity = 0   # rejections by the velocity limits (421 / 422)
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+        self.rejected += other.rejected
+        self.velocity += other.velocity
+
+    def summary(self, elapsed):
+        ordered = sorted(self.latencies)
+        return {
+            "requests": len(ordered),
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "velocity_rejected": self.velocity,
+            "throughput": len(ordered) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(ordered, 0.50) * 1000,
+            "p95_ms": percentile(ordered, 0.95) * 1000,
+            "p99_ms": percentile(ordered, 0.99) * 1000,
+            "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+        }
+
+
+class Worker(threading.Thread):
+    """Sends transactions on one keep-alive connection until the deadline"""
+
+    def __init__(self, index, config, cards, start_at, deadline):
+        threading.Thread.__init__(self, name="load-%d" % index, daemon=True)
+        self.config = config
+        self.cards = cards
+        self.start_at = start_at
+        self.deadline = deadline
+        self.random = random.Random(config.seed + index)
+        self.validate = RouteStats()
+        self.settle = RouteStats()
+        self.approved = []
+        # Each worker gets an equal share of the requested rate
+        self.interval = config.concurrency / config.rate if config.rate else 0.0
+        # Stagger the workers so a rate-limited run does not send in bursts
+        self.next_send = start_at + self.interval * index / config.concurrency
+
+    def make_transaction(self):
+        if self.random.random() < self.config.bad_ratio:
+            card = BAD_CARD
+        else:
+            card = self.random.choice(self.cards)
+        transaction = CCTransaction(card["name"], card["id"], card["card_code"],
+                                    card["exp_month"], card["exp_year"],
+                                    card.get("currency", "usd"))
+        transaction.set_amount(self.random.randint(100, self.config.max_amount))
+        merchant = self.random.randrange(self.config.merchants)
+        transaction.set_merchant_data("Load Merchant %d" % merchant, "merch_load_%d" % merchant)
+        return transaction
+
+    def post(self, session, url, body, stats, scheduled=None):
+        """
+        Posts body; returns the response text, or None on an error.
+        With a rate, latency is timed from when the request was scheduled,
+        not when it went out, so a server falling behind is not hidden by
+        the sends it delays (coordinated omission).
+        """
+        start = time.perf_counter() if scheduled is None else scheduled
+        try:
+            response = session.post(url, data=body, verify=not self.config.insecure,
+                                    timeout=self.config.timeout)
+            elapsed = time.perf_counter() - start
+        except requests.RequestException:
+            stats.errors += 1
+            return None
+        if response.status_code != 200:
+            stats.errors += 1
+            return None
+        stats.latencies.append(elapsed)
+        return response.text
+
+    def settle_approved(self, session):
+        if not self.approved:
+            return
+        text = self.post(session, self.config.url + "/api/settle",
+                         CCTransaction.list_to_json(self.approved), self.settle)
+        if text is not None:
+            self.settle.rejected += len(json.loads(text)["unsettled"])
+        self.approved = []
+
+    def run(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        while True:
+            now = time.perf_counter()
+            scheduled = None
+            if self.interval:
+                if self.next_send > now:
+                    time.sleep(self.next_send - now)
+                scheduled = self.next_send
+                self.next_send += self.interval
+            if time.perf_counter() >= self.deadline:
+                break
+            transaction = self.make_transaction()
+            text = self.post(session, self.config.url + "/api/validate",
+                             transaction.to_json(), self.validate, scheduled)
+            if text is None:
+                continue
+            response = CCTransaction.from_json(text)
+            if response.data.get("approval_code"):
+                self.approved.append(response)
+                if len(self.approved) >= self.config.settle_every:
+                    self.settle_approved(session)
+            else:
+                self.validate.rejected += 1
+                if response.data.get("failure_code") in (CARD_VELOCITY_FAILURE,
+                                                         MERCHANT_VELOCITY_FAILURE):
+                    self.validate.velocity += 1
+        self.settle_approved(session)
+        session.close()
+
+
+def run_load(config, cards, concurrency):
+    """Runs one load level and returns its report"""
+    config.concurrency = concurrency
+    start_at = time.perf_counter()
+    deadline = start_at + config.duration
+    workers = [Worker(i, config, cards, start_at, deadline) for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start_at
+
+    validate = RouteStats()
+    settle = RouteStats()
+    for worker in workers:
+        validate.merge(worker.validate)
+        settle.merge(worker.settle)
+    return {
+        "url": config.url,
+        "concurrency": concurrency,
+        "rate": config.rate,
+        "duration": elapsed,
+        "validate": validate.summary(elapsed),
+        "settle": settle.summary(elapsed),
+    }
+
+
+def print_report(report):
+    print("\n%s  concurrency=%d  rate=%s  %.1fs" % (report["url"], report["concurrency"],
+                                                  report["rate"] or "max", report["duration"]))
+    print("%-10s %9s %7s %9s %10s %9s %9s %9s %9s" %
+          ("route", "requests", "errors", "rejected", "req/s",
+           "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for route in ("validate", "settle"):
+        stats = report[route]
+        print("%-10s %9d %7d %9d %10.1f %9.2f %9.2f %9.2f %9.2f" %
+              (route, stats["requests"], stats["errors"], stats["rejected"],
+               stats["throughput"], stats["p50_ms"], stats["p95_ms"],
+               stats["p99_ms"], stats["max_ms"]))
+    validate = report["validate"]
+    if validate["requests"] and \
+       validate["velocity_rejected"] > VELOCITY_WARNING * validate["requests"]:
+        print("Warning: %d of %d validates were refused by velocity limits (421/422); this "
+              "measures the rejection path. Set cc_velocity_card_limits = [] in the service "
+              "for capacity runs." % (validate["velocity_rejected"], validate["requests"]))
+
+
+def find_saturation(reports):
+    """
+    Returns the concurrency with the highest validate throughput,
+    or None if throughput was still rising at the last level swept.
+    """
+    best = max(reports, key=lambda report: report["validate"]["throughput"])
+    if best is reports[-1]:
+        return None
+    return best["concurrency"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load generator for the validation service")
+    parser.add_argument("--url", default=DEFAULT_URL,
+                        help="service base URL (default %s)" % DEFAULT_URL)
+    parser.add_argument("--concurrency", type=int, default=4, help="worker connections")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="total validate requests per second; 0 is as fast as possible")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per load level")
+    parser.add_argument("--settle-every", type=int, default=25,
+                        help="approved transactions per settlement batch")
+    parser.add_argument("--cards", default=DEFAULT_CARDS_FILE, help="card mix (JSON card book)")
+    parser.add_argument("--merchants", type=int, default=10, help="number of distinct merchants")
+    parser.add_argument("--bad-ratio", type=float, default=0.0,
+                        help="fraction of transactions sent with an invalid card")
+    parser.add_argument("--max-amount", type=int, default=20000, help="largest amount in cents")
+    parser.add_argument("--sweep", help="comma separated concurrency levels, e.g. 1,2,4,8")
+    parser.add_argument("--insecure", action="store_true",
+                        help="do not verify the TLS certificate (self-signed localhost.pem)")
+    parser.add_argument("--timeout", type=float, default=10, help="per request timeout")
+    parser.add_argument("--seed", type=int, default=4310, help="random seed for the mix")
+    parser.add_argument("--json", help="write the report(s) to this file")
+    config = parser.parse_args(argv)
+    config.url = config.url.rstrip("/")
+
+    if config.insecure:
+        requests.packages.urllib3.disable_warnings()
+    cards = load_cards(config.cards)
+
+    levels = [int(level) for level in config.sweep.split(",")] if config.sweep \
+        else [config.concurrency]
+    reports = []
+    for level in levels:
+        report = run_load(config, cards, level)
+        print_report(report)
+        reports.append(report)
+
+    result = {"reports": reports}
+    if len(reports) > 1:
+        result["saturation_concurrency"] = find_saturation(reports)
+        print("\nSaturation at concurrency: %s" % (result["saturation_concurrency"] or
+                                                  "not reached"))
+    if config.json:
+        with open(config.json, "w") as f:
+            json.dump(result, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+   Author: M I Schwartz
+
+   Admission control and per-merchant rate limiting for the service.
+
+   * AdmissionController bounds the number of requests being processed;
+       a request over the bound is refused at once (503) instead of queueing
+   * TokenBucket refills at `rate` tokens per second up to `burst`
+   * TokenBucketLimiter keeps one bucket per key (merchant network_id, or
+       client address); a request charging several keys takes its tokens from
+       all of them or from none. Buckets idle long enough to be full again are
+       evicted, and at most max_keys are kept (least recently used first)
+"""
+
+import collections
+import threading
+import time
+
+DEFAULT_MAX_KEYS = 100000
+
+
+class AdmissionController:
+    """A non-blocking bound on requests in flight; max_in_flight of 0 is unbounded"""
+
+    def __init__(self, max_in_flight=0):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        """Admits a request if there is room; every admitted request must call leave()"""
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class TokenBucket:
+    """Tokens refill at rate per second, up to burst"""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, rate, burst, now):
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait(self, count, rate):
+        """Seconds until count tokens are available (count must not exceed the burst)"""
+        if self.tokens >= count:
+            return 0.0
+        return (count - self.tokens) / rate
+
+
+class TokenBucketLimiter:
+    """One token bucket per key; rate of 0 disables limiting"""
+
+    def __init__(self, rate, burst, max_keys=DEFAULT_MAX_KEYS, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.clock = clock
+        # A bucket idle this long is full again, so forgetting it changes nothing
+        self.idle = self.burst / self.rate if self.rate else 0.0
+        self.limited = 0
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key, count=1):
+        """Takes count tokens for key; returns 0 if allowed, else the seconds to wait"""
+        return self.acquire_many({key: count})
+
+    def acquire_many(self, counts):
+        """
+        Takes counts[key] tokens for every key, or none at all if any bucket is short.
+        Returns 0 if allowed, else the seconds until all of them would be.
+        A count over the burst can never be allowed; check too_large first.
+        """
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            buckets = []
+            wait = 0.0
+            for key, count in counts.items():
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.burst, now)
+                    self._buckets[key] = bucket
+                else:
+                    self._buckets.move_to_end(key)
+                bucket.refill(self.rate, self.burst, now)
+                wait = max(wait, bucket.wait(count, self.rate))
+                buckets.append((bucket, count))
+            if wait:
+                self.limited += 1
+            else:
+                for bucket, count in buckets:
+                    bucket.tokens -= count
+            self._evict(now)
+            return wait
+
+    def too_large(self, count):
+        """True if count tokens exceed the burst, so they can never be taken at once"""
+        return bool(self.rate) and count > self.burst
+
+    def _evict(self, now):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if len(self._buckets) > self.max_keys or now - bucket.updated > self.idle:
+                del self._buckets[key]
+            else:
+                break
+
+    def __len__(self):
+        return len(self._buckets)
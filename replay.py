@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+   Author: M I Schwartz
+
+   Replays a traffic capture (traffic_capture.py) against a service and
+   compares the responses and latencies with the captured ones.
+
+   * Requests are sent at their captured offsets (--speed 2 is twice as fast),
+     or as fast as --concurrency connections allow with --fast
+   * Approval codes differ between runs, so each /api/validate response maps
+     the captured approval codes to the new ones, and later requests that
+     carry a captured code (settlements, archive lookups) are sent with the
+     new code; such a request waits until the validation that issued its code
+     has been replayed
+   * Responses are compared after mapping approval codes and ignoring the
+     fields that differ on every run (--ignore, settlement_id by default);
+     /api/store listings are compared without regard to order
+   * Latency percentiles are reported per route, captured vs replayed.
+     Captured latency is the server's time handling the request; replayed
+     latency is the round trip seen here. To compare two servers or code
+     versions like for like, replay against each and pass the first
+     replay's --json to the second as --baseline
+   * Rate dependent decisions (velocity limits, merchant token buckets,
+     admission control) may differ when the timing does, above all with --fast
+
+   The capture tokenized card numbers, so a replay server that checks enrolled
+   cards (ccstore) needs the card book tokenized with the same key:
+       python3 replay.py --tokenize-card-book enrolled_credit_cards.json tokenized.json --key K
+
+   Usage::
+       python3 replay.py capture.jsonl.gz
+       python3 replay.py capture.jsonl.gz --fast --concurrency 16
+       python3 replay.py capture.jsonl.gz --url https://localhost:8443 --insecure --json diff.json
+       python3 replay.py capture.jsonl.gz --baseline diff.json
+
+   The exit status is 1 if any response differs.
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import traffic_capture
+import wire_format
+
+from load_generator import percentile
+
+DEFAULT_URL = "http://localhost:8000"
+DEFAULT_IGNORE = ("settlement_id",)
+DEPENDENCY_TIMEOUT = 30     # seconds a request waits for the validation that issued its codes
+UNORDERED_PATHS = ("/api/store",)
+
+
+def _walk_strings(data):
+    if isinstance(data, dict):
+        for value in data.values():
+            yield from _walk_strings(value)
+    elif isinstance(data, list):
+        for item in data:
+            yield from _walk_strings(item)
+    elif isinstance(data, str):
+        yield data
+
+
+def _approval_codes(data):
+    """The approval codes in a /api/validate response (a transaction or a list of them)"""
+    if isinstance(data, dict):
+        return [data["approval_code"]] if data.get("approval_code") else []
+    if isinstance(data, list):
+        return [code for item in data for code in _approval_codes(item)]
+    return []
+
+
+def _substitute(data, mapping):
+    """Returns data with every string that is a captured approval code replaced by the new one"""
+    if isinstance(data, dict):
+        return {key: _substitute(value, mapping) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_substitute(item, mapping) for item in data]
+    if isinstance(data, str):
+        return mapping.get(data, data)
+    return data
+
+
+def _ignore(data, ignored):
+    if isinstance(data, dict):
+        return {key: "<ignored>" if key in ignored else _ignore(value, ignored)
+                for key, value in data.items()}
+    if isinstance(data, list):
+        return [_ignore(item, ignored) for item in data]
+    return data
+
+
+def normalize(data, path, mapping, ignored):
+    """A response in the form it is compared in"""
+    data = _ignore(_substitute(data, mapping), ignored)
+    if path in UNORDERED_PATHS and isinstance(data, list):
+        data = sorted(data, key=lambda item: json.dumps(item, sort_keys=True))
+    return data
+
+
+class Replay:
+    """One replay of a list of captured records"""
+
+    def __init__(self, records, config):
+        self.records = records
+        self.config = config
+        self.ignored = set(config.ignore or DEFAULT_IGNORE)
+        self.mapping = {}               # captured approval code -> replayed approval code
+        self.results = [None] * len(records)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        # Which validation issued each captured approval code
+        self.producer = {}
+        for index, record in enumerate(records):
+            if record["path"] == "/api/validate":
+                for code in _approval_codes(record.get("response")):
+                    self.producer.setdefault(code, index)
+        self.done = {index: threading.Event() for index in set(self.producer.values())}
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+        return session
+
+    def _wait_for_producers(self, index, request):
+        for value in _walk_strings(request):
+            producer = self.producer.get(value)
+            if producer is not None and producer < index:
+                self.done[producer].wait(DEPENDENCY_TIMEOUT)
+
+    def _encode(self, record, request):
+        headers = {}
+        for header, field in (("Content-Type", "content_type"), ("Accept", "accept")):
+            if record.get(field):
+                headers[header] = record[field]
+        if "request_text" in record:
+            body = record["request_text"].encode("utf-8")
+        elif wire_format.is_msgpack(record.get("content_type")):
+            body = wire_format.packb(request)
+        else:
+            body = json.dumps(request).encode("utf-8")
+        if (record.get("content_encoding") or "").lower() in ("gzip", "x-gzip"):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    @staticmethod
+    def _decode(response):
+        if wire_format.is_msgpack(response.headers.get("Content-Type")):
+            try:
+                return wire_format.unpackb(response.content), None
+            except ValueError:
+                return None, repr(response.content)
+        try:
+            return response.json(), None
+        except ValueError:
+            return None, response.text
+
+    def send(self, index):
+        record = self.records[index]
+        try:
+            request = record.get("request")
+            if "request_text" not in record:
+                self._wait_for_producers(index, request)
+                with self._lock:
+                    request = _substitute(request, self.mapping)
+            body, headers = self._encode(record, request)
+            started = time.perf_counter()
+            try:
+                response = self._session().request(
+                    record.get("method", "POST"), self.config.url + record["path"],
+                    data=body, headers=headers, verify=not self.config.insecure,
+                    timeout=self.config.timeout)
+            except requests.RequestException as err:
+                self.results[index] = {"latency": time.perf_counter() - started,
+                                       "status": None, "error": str(err)}
+                return
+            latency = time.perf_counter() - started
+            data, text = self._decode(response)
+            self.results[index] = {"latency": latency, "status": response.status_code,
+                                   "response": data, "response_text": text}
+            if record["path"] == "/api/validate":
+                self._map_codes(record.get("response"), data)
+        finally:
+            if index in self.done:
+                self.done[index].set()
+
+    def _map_codes(self, captured, replayed):
+        if isinstance(captured, list) and isinstance(replayed, list) and \
+           len(captured) == len(replayed):
+            for old, new in zip(captured, replayed):
+                self._map_codes(old, new)
+        elif isinstance(captured, dict) and isinstance(replayed, dict):
+            if captured.get("approval_code") and replayed.get("approval_code"):
+                with self._lock:
+                    self.mapping[captured["approval_code"]] = replayed["approval_code"]
+
+    def run(self):
+        """Sends every record; returns the elapsed seconds"""
+        speed = self.config.speed
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.config.concurrency,
+                                thread_name_prefix="replay") as executor:
+            for index, record in enumerate(self.records):
+                if not self.config.fast:
+                    delay = started + record["t"] / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self.send, index)
+        return time.monotonic() - started
+
+    def compare(self):
+        """Returns the list of differences, one dict per request that differs"""
+        differences = []
+        for index, (record, result) in enumerate(zip(self.records, self.results)):
+            if result is None or result.get("error"):
+                differences.append({"index": index, "path": record["path"],
+                                    "error": (result or {}).get("error", "not sent")})
+                continue
+            if record.get("status") != result["status"]:
+                differences.append({"index": index, "path": record["path"],
+                                    "captured_status": record.get("status"),
+                                    "replayed_status": result["status"]})
+                continue
+            if "response_text" in record or record.get("response") is None:
+                # Error pages and streamed responses are compared by status only
+                continue
+            captured = normalize(record["response"], record["path"], self.mapping, self.ignored)
+            replayed = normalize(result["response"], record["path"], {}, self.ignored)
+            if captured != replayed:
+                differences.append({"index": index, "path": record["path"],
+                                    "captured": captured, "replayed": replayed})
+        return differences
+
+    def latency_report(self):
+        """Captured vs replayed latency percentiles per route, in milliseconds"""
+        routes = {}
+        for record, result in zip(self.records, self.results):
+            captured, replayed = routes.setdefault(record["path"], ([], []))
+            captured.append(record.get("latency", 0.0))
+            if result is not None and result.get("status") is not None:
+                replayed.append(result["latency"])
+        report = {}
+        for path, (captured, replayed) in sorted(routes.items()):
+            report[path] = {}
+            for name, latencies in (("captured", captured), ("replayed", replayed)):
+                ordered = sorted(latencies)
+                report[path][name] = {
+                    "requests": len(ordered),
+                    "p50_ms": percentile(ordered, 0.50) * 1000,
+                    "p95_ms": percentile(ordered, 0.95) * 1000,
+                    "p99_ms": percentile(ordered, 0.99) * 1000,
+                    "max_ms": (ordered[-1] if ordered else 0.0) * 1000,
+                }
+        return report
+
+
+def print_report(latencies, differences, elapsed, captured_span, show):
+    print("Replayed in %.1fs (captured over %.1fs)" % (elapsed, captured_span))
+    print("%-24s %-9s %9s %9s %9s %9s %9s" %
+          ("route", "", "requests", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for path, runs in latencies.items():
+        for name in ("captured", "baseline", "replayed"):
+            if name not in runs:
+                continue
+            stats = runs[name]
+            print("%-24s %-9s %9d %9.2f %9.2f %9.2f %9.2f" %
+                  (path if name == "captured" else "", name, stats["requests"],
+                   stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+    print("\n%d response(s) differ" % len(differences))
+    for difference in differences[:show]:
+        print(json.dumps(difference, sort_keys=True)[:1000])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against the service")
+    parser.add_argument("capture", nargs="?", help="capture file written by the service")
+    parser.add_argument("--url", default=DEFAULT_URL,
+                        help="service base URL (default %s)" % DEFAULT_URL)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to the capture (2 is twice as fast)")
+    parser.add_argument("--fast", action="store_true", help="send as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8, help="connections")
+    parser.add_argument("--ignore", action="append",
+                        help="response field to leave out of the comparison (repeatable; "
+                             "default %s)" % ", ".join(DEFAULT_IGNORE))
+    parser.add_argument("--show", type=int, default=10, help="differences to print")
+    parser.add_argument("--insecure", action="store_true",
+                        help="do not verify the TLS certificate (self-signed localhost.pem)")
+    parser.add_argument("--timeout", type=float, default=10, help="per request timeout")
+    parser.add_argument("--json", help="write the latencies and differences to this file")
+    parser.add_argument("--baseline", help="an earlier replay's --json, to compare latencies with")
+    parser.add_argument("--tokenize-card-book", nargs=2, metavar=("SOURCE", "DESTINATION"),
+                        help="write a tokenized copy of a card book (needs --key) and exit")
+    parser.add_argument("--key", help="the service's cc_capture_token_key")
+    config = parser.parse_args(argv)
+    config.url = config.url.rstrip("/")
+
+    if config.tokenize_card_book:
+        if not config.key:
+            parser.error("--tokenize-card-book needs --key")
+        traffic_capture.tokenize_card_book(config.tokenize_card_book[0],
+                                           config.tokenize_card_book[1], config.key)
+        return 0
+    if not config.capture:
+        parser.error("a capture file is required")
+    if config.insecure:
+        requests.packages.urllib3.disable_warnings()
+
+    records = list(traffic_capture.read_capture(config.capture))
+    replay = Replay(records, config)
+    elapsed = replay.run()
+    differences = replay.compare()
+    latencies = replay.latency_report()
+    if config.baseline:
+        with open(config.baseline) as f:
+            baseline = json.load(f)["latencies"]
+        for path, runs in latencies.items():
+            if path in baseline:
+                runs["baseline"] = baseline[path]["replayed"]
+    print_report(latencies, differences, elapsed,
+                 records[-1]["t"] if records else 0.0, config.show)
+    if config.json:
+        with open(config.json, "w") as f:
+            json.dump({"elapsed": elapsed, "requests": len(records),
+                       "latencies": latencies, "differences": differences}, f, indent=2)
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,472 @@
+"""
+   Author: M I Schwartz
+
+   Append-only archive of settled transactions.
+
+   datastore.settle removes a transaction once it is settled; the archive keeps it.
+   Settled transactions are appended to segment files in a directory:
+       segment_000001.log, segment_000002.log, ...
+   A new segment is started once the current one passes segment_size bytes.
+
+   Each record is length-prefixed:
+       header   struct "<4sIdHH": magic b"CCST", payload length, settled time (epoch seconds),
+                settlement_id length, approval_code length
+       settlement_id  (ascii)
+       approval_code  (ascii)
+       payload        the transaction as compact JSON
+
+   Only the open segment is indexed in memory. When a segment is full it is
+   sealed: its index is written beside it (segment_000001.idx) as two tables
+   sorted by approval code and by settlement id, which lookups binary search
+   through a memory map. Memory therefore stays flat however long the service
+   runs, and opening the archive reads the sealed indexes instead of
+   rescanning their segments (a segment whose index is missing or stale is
+   scanned and its index written again).
+
+   A record cut short at the end of the last segment (a write interrupted
+   by a crash) is truncated away; any other damage is logged and left on
+   disk for inspection, and appends go to a new segment.
+
+   Records are read back through memory maps, at most max_maps of them open
+   at once (least recently used are closed), and exports join the stored
+   JSON payloads without parsing them.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+_HEADER = struct.Struct("<4sIdHH")
+_MAGIC = b"CCST"
+_SEGMENT_PATTERN = "segment_%06d.log"
+
+# Sealed segment index: header, then days (JSON), then the two tables.
+# header: magic, version, segment size indexed, entry count, code width, settlement id width,
+#         length of the days JSON
+_INDEX_HEADER = struct.Struct("<4sHQIHHI")
+_INDEX_MAGIC = b"CCSI"
+_INDEX_VERSION = 1
+_INDEX_PATTERN = "segment_%06d.idx"
+# Each table entry is a key padded with NULs to its table's width, then this
+_ENTRY = struct.Struct("<Qd")   # record offset, settled time
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_MAPS = 8
+
+
+def _day(timestamp):
+    return datetime.date.fromtimestamp(timestamp).isoformat()
+
+
+def _day_bounds(day):
+    """The epoch seconds [start, end) of a local day "YYYY-MM-DD"; None if it is not a date"""
+    try:
+        date = datetime.date.fromisoformat(day)
+    except ValueError:
+        return None
+    start = datetime.datetime.combine(date, datetime.time())
+    return start.timestamp(), (start + datetime.timedelta(days=1)).timestamp()
+
+
+class _OpenIndex:
+    """The in-memory index of the segment being appended to"""
+
+    def __init__(self):
+        self.by_approval = {}     # approval_code -> (offset, settled_at)
+        self.by_settlement = {}   # settlement_id -> [(offset, settled_at)]
+        self.days = set()
+
+    def add(self, offset, settlement_id, approval_code, settled_at):
+        self.by_approval[approval_code] = (offset, settled_at)
+        self.by_settlement.setdefault(settlement_id, []).append((offset, settled_at))
+        self.days.add(_day(settled_at))
+
+    def find_approval(self, approval_code):
+        return self.by_approval.get(approval_code)
+
+    def find_settlement(self, settlement_id):
+        return self.by_settlement.get(settlement_id, [])
+
+    def entries(self):
+        """(offset, settled_at) of every record"""
+        return self.by_approval.values()
+
+    def write(self, path, size, sync):
+        """Writes the index of a sealed segment of size bytes"""
+        codes = sorted((code.encode("ascii"), entry)
+                       for code, entry in self.by_approval.items())
+        settlements = sorted((sid.encode("ascii"), entry)
+                             for sid, entries in self.by_settlement.items()
+                             for entry in entries)
+        code_width = max([len(code) for code, _ in codes] or [0])
+        sid_width = max([len(sid) for sid, _ in settlements] or [0])
+        days = json.dumps(sorted(self.days)).encode("ascii")
+        parts = [_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, size, len(codes),
+                                    code_width, sid_width, len(days)), days]
+        for table, width in ((codes, code_width), (settlements, sid_width)):
+            for key, (offset, settled_at) in table:
+                parts.append(key.ljust(width, b"\0"))
+                parts.append(_ENTRY.pack(offset, settled_at))
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(parts))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+
+class _SealedIndex:
+    """The on-disk index of a sealed segment, searched through a memory map"""
+
+    def __init__(self, path, header, days):
+        (_, _, self.size, self.count, self.code_width, self.sid_width,
+         days_length) = header
+        self.path = path
+        self.days = set(days)
+        self.codes_start = _INDEX_HEADER.size + days_length
+        self.settlements_start = self.codes_start + self.count * (self.code_width + _ENTRY.size)
+
+    @classmethod
+    def load(cls, path, segment_size):
+        """Returns the index if it is readable and matches the segment's size, else None"""
+        try:
+            with open(path, "rb") as f:
+                header = _INDEX_HEADER.unpack(f.read(_INDEX_HEADER.size))
+                if header[0] != _INDEX_MAGIC or header[1] != _INDEX_VERSION or \
+                   header[2] != segment_size:
+                    return None
+                days = json.loads(f.read(header[6]))
+            index = cls(path, header, days)
+            if os.path.getsize(path) != index.settlements_start + \
+               index.count * (index.sid_width + _ENTRY.size):
+                return None
+            return index
+        except (OSError, struct.error, ValueError):
+            return None
+
+    def _search(self, mapped, start, width, key):
+        """The position of the first entry whose key is key, or None"""
+        if len(key) > width:
+            return None
+        padded = key.ljust(width, b"\0")
+        size = width + _ENTRY.size
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            position = start + middle * size
+            if mapped[position:position + width] < padded:
+                low = middle + 1
+            else:
+                high = middle
+        position = start + low * size
+        if low < self.count and mapped[position:position + width] == padded:
+            return position
+        return None
+
+    def find_approval(self, mapped, approval_code):
+        position = self._search(mapped, self.codes_start, self.code_width,
+                                approval_code.encode("ascii", "replace"))
+        if position is None:
+            return None
+        return _ENTRY.unpack_from(mapped, position + self.code_width)
+
+    def find_settlement(self, mapped, settlement_id):
+        key = settlement_id.encode("ascii", "replace")
+        position = self._search(mapped, self.settlements_start, self.sid_width, key)
+        if position is None:
+            return []
+        padded = key.ljust(self.sid_width, b"\0")
+        size = self.sid_width + _ENTRY.size
+        end = self.settlements_start + self.count * size
+        entries = []
+        while position < end and mapped[position:position + self.sid_width] == padded:
+            entries.append(_ENTRY.unpack_from(mapped, position + self.sid_width))
+            position += size
+        return entries
+
+    def entries(self, mapped):
+        """(offset, settled_at) of every record"""
+        size = self.code_width + _ENTRY.size
+        return [_ENTRY.unpack_from(mapped, self.codes_start + i * size + self.code_width)
+                for i in range(self.count)]
+
+
+class SettlementArchive:
+    """Append-only, indexed store of settled transactions"""
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, sync=False,
+                 max_maps=DEFAULT_MAX_MAPS):
+        """sync=True forces each appended batch to disk with fsync"""
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.max_maps = max_maps
+        self._lock = threading.Lock()
+        self._sealed = collections.OrderedDict()   # segment -> _SealedIndex, oldest first
+        self._index = _OpenIndex()
+        self._maps = collections.OrderedDict()     # path -> mmap, least recently used first
+        self._segment = 0
+        self._file = None
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        for segment in segments[:-1]:
+            self._load_sealed(segment)
+        if segments:
+            if self._scan(segments[-1], self._index, last=True):
+                self._segment = segments[-1]
+            else:
+                self._seal(segments[-1], self._index)
+                self._index = _OpenIndex()
+                self._segment = segments[-1] + 1
+        self._open_segment(self._segment or 1)
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment_") and name.endswith(".log"):
+                segments.append(int(name[len("segment_"):-len(".log")]))
+        return sorted(segments)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, _SEGMENT_PATTERN % segment)
+
+    def _index_path(self, segment):
+        return os.path.join(self.directory, _INDEX_PATTERN % segment)
+
+    def _load_sealed(self, segment):
+        """Loads a sealed segment's index, scanning it and writing the index if need be"""
+        sealed = _SealedIndex.load(self._index_path(segment),
+                                   os.path.getsize(self._path(segment)))
+        if sealed is None:
+            index = _OpenIndex()
+            self._scan(segment, index, last=False)
+            self._seal(segment, index)
+        else:
+            self._sealed[segment] = sealed
+
+    def _seal(self, segment, index):
+        """Writes a full (or damaged) segment's index and searches it on disk from now on"""
+        size = os.path.getsize(self._path(segment))
+        path = self._index_path(segment)
+        self._close_map(path)
+        index.write(path, size, self.sync)
+        self._sealed[segment] = _SealedIndex.load(path, size)
+
+    def _scan(self, segment, index, last):
+        """
+        Indexes one segment from its record headers; False if it is damaged.
+        A torn record at the end of the last segment is truncated instead.
+        """
+        path = self._path(segment)
+        size = os.path.getsize(path)
+        valid_end = 0
+        torn = False
+        with open(path, "rb") as f:
+            while valid_end < size:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    torn = True
+                    break
+                magic, length, settled_at, sid_len, code_len = _HEADER.unpack(header)
+                if magic != _MAGIC:
+                    break
+                keys = f.read(sid_len + code_len)
+                if len(keys) < sid_len + code_len or f.tell() + length > size:
+                    torn = True
+                    break
+                try:
+                    settlement_id = keys[:sid_len].decode("ascii")
+                    approval_code = keys[sid_len:].decode("ascii")
+                except UnicodeDecodeError:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                index.add(valid_end, settlement_id, approval_code, settled_at)
+                valid_end = f.tell()
+        if valid_end == size:
+            return True
+        if torn and last:
+            logging.warning("Settlement archive %s: dropping a torn record at offset %d\n",
+                            path, valid_end)
+            with open(path, "r+b") as f:
+                f.truncate(valid_end)
+            return True
+        logging.error("Settlement archive %s: unreadable record at offset %d; "
+                      "%d bytes after it are not indexed\n", path, valid_end, size - valid_end)
+        return False
+
+    def _open_segment(self, segment):
+        if self._file:
+            self._file.close()
+        self._segment = segment
+        self._file = open(self._path(segment), "ab")
+
+    def append(self, settlement):
+        """Archives the settled transactions of a CCSettlement; returns how many"""
+        if not settlement.transactions:
+            return 0
+        settled_at = time.time()
+        sid = settlement.settlement_id.encode("ascii")
+        with self._lock:
+            if self._file.tell() >= self.segment_size:
+                self._file.close()
+                self._file = None
+                self._seal(self._segment, self._index)
+                self._index = _OpenIndex()
+                self._open_segment(self._segment + 1)
+            records = []
+            locations = []
+            start = offset = self._file.tell()
+            for transaction in settlement.transactions:
+                code = str(transaction.data["approval_code"]).encode("ascii")
+                payload = json.dumps(transaction.data, separators=(",", ":")).encode("utf-8")
+                records.append(_HEADER.pack(_MAGIC, len(payload), settled_at, len(sid), len(code)))
+                records.append(sid)
+                records.append(code)
+                records.append(payload)
+                locations.append((offset, code.decode("ascii")))
+                offset += _HEADER.size + len(sid) + len(code) + len(payload)
+            try:
+                self._file.write(b"".join(records))
+                self._file.flush()
+                if self.sync:
+                    os.fsync(self._file.fileno())
+            except BaseException:
+                self._discard(start)
+                raise
+            for offset, code in locations:
+                self._index.add(offset, settlement.settlement_id, code, settled_at)
+        return len(settlement.transactions)
+
+    def _discard(self, end):
+        """Drops what a failed append left past end, so the batch can be settled again"""
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        with open(self._path(self._segment), "r+b") as f:
+            f.truncate(end)
+        self._file = open(self._path(self._segment), "ab")
+
+    def _map(self, path, end=0):
+        """Returns a memory map of a file covering at least `end` bytes; the caller holds _lock"""
+        mapped = self._maps.get(path)
+        if mapped is None or len(mapped) < end:
+            self._close_map(path)
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = mapped
+            while len(self._maps) > self.max_maps:
+                _, oldest = self._maps.popitem(last=False)
+                oldest.close()
+        else:
+            self._maps.move_to_end(path)
+        return mapped
+
+    def _close_map(self, path):
+        mapped = self._maps.pop(path, None)
+        if mapped is not None:
+            mapped.close()
+
+    def _payload(self, segment, offset):
+        """Returns the raw JSON bytes of the record at offset; the caller holds _lock"""
+        path = self._path(segment)
+        mapped = self._map(path, offset + _HEADER.size)
+        _, length, _, sid_len, code_len = _HEADER.unpack_from(mapped, offset)
+        start = offset + _HEADER.size + sid_len + code_len
+        mapped = self._map(path, start + length)
+        return mapped[start:start + length]
+
+    def _find_approval(self, approval_code):
+        """(segment, offset) of the record of an approval code, or None; the caller holds _lock"""
+        entry = self._index.find_approval(approval_code)
+        if entry is not None:
+            return self._segment, entry[0]
+        for segment in reversed(self._sealed):
+            sealed = self._sealed[segment]
+            entry = sealed.find_approval(self._map(sealed.path), approval_code)
+            if entry is not None:
+                return segment, entry[0]
+        return None
+
+    def _settlement_payloads(self, settlement_id):
+        with self._lock:
+            payloads = []
+            for segment, sealed in self._sealed.items():
+                for offset, _ in sealed.find_settlement(self._map(sealed.path), settlement_id):
+                    payloads.append(self._payload(segment, offset))
+            for offset, _ in self._index.find_settlement(settlement_id):
+                payloads.append(self._payload(self._segment, offset))
+            return payloads
+
+    def is_settled(self, approval_code):
+        """True if the approval code has been settled and archived"""
+        with self._lock:
+            return self._find_approval(approval_code) is not None
+
+    def lookup_approval(self, approval_code):
+        """Returns the settled transaction for an approval code, or None"""
+        with self._lock:
+            location = self._find_approval(approval_code)
+            if location is None:
+                return None
+            payload = self._payload(*location)
+        return json.loads(payload)
+
+    def lookup_settlement(self, settlement_id):
+        """Returns the transactions settled under a settlement id"""
+        return [json.loads(payload) for payload in self._settlement_payloads(settlement_id)]
+
+    def settlement_json(self, settlement_id):
+        """Returns the transactions of a settlement as a JSON array string, without re-parsing"""
+        return self._join(self._settlement_payloads(settlement_id))
+
+    def export_day_json(self, day):
+        """Returns a day's settled transactions (day is "YYYY-MM-DD") as a JSON array string"""
+        day = str(day)
+        bounds = _day_bounds(day)
+        if bounds is None:
+            return "[]"
+        start, end = bounds
+        payloads = []
+        with self._lock:
+            segments = [(segment, sealed) for segment, sealed in self._sealed.items()
+                        if day in sealed.days]
+            for segment, sealed in segments:
+                entries = sealed.entries(self._map(sealed.path))
+                for offset, settled_at in sorted(entries):
+                    if start <= settled_at < end:
+                        payloads.append(self._payload(segment, offset))
+            if day in self._index.days:
+                for offset, settled_at in sorted(self._index.entries()):
+                    if start <= settled_at < end:
+                        payloads.append(self._payload(self._segment, offset))
+        return self._join(payloads)
+
+    @staticmethod
+    def _join(payloads):
+        return (b"[" + b",".join(payloads) + b"]").decode("utf-8")
+
+    def days(self):
+        """Returns the settlement days present in the archive"""
+        with self._lock:
+            days = set(self._index.days)
+            for sealed in self._sealed.values():
+                days |= sealed.days
+        return sorted(days)
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = collections.OrderedDict()
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,148 @@
+"""
+   Author: M I Schwartz
+
+   Background settlement of the unsettled store, replacing settle_remaining.sh.
+
+   settle_remaining.sh pulls the whole verbose /api/store dump and posts it
+   back to /api/settle, parsing the book twice over HTTP, and only when
+   someone runs it. The scheduler runs inside the service instead:
+    * a sweep starts every `interval` seconds, or as soon as the store holds
+      `size_threshold` transactions
+    * each sweep settles in chunks of at most `chunk_size` transactions,
+      oldest first, straight through datastore and CCSettlement
+    * between chunks it backs off while the service is busy, i.e. while
+      load() reports more than `max_load` requests in flight
+    * status() reports its progress
+
+   Note: a transaction swept here is settled under the scheduler's settlement
+   id; a merchant settling it afterwards gets "No such unsettled transaction".
+"""
+
+import logging
+import threading
+import time
+
+import datastore
+
+from cc_settlement import CCSettlement
+from cc_transaction import CCTransaction
+
+
+class SettlementScheduler(threading.Thread):
+    """Settles the unsettled store periodically, in bounded chunks"""
+
+    def __init__(self, interval=300, size_threshold=0, chunk_size=1000,
+                 load=None, max_load=4, poll_interval=1.0,
+                 backoff=0.5, max_backoff=30.0):
+        """
+        interval:       seconds between sweeps; 0 sweeps only on size_threshold
+        size_threshold: store size that starts a sweep early; 0 disables
+        chunk_size:     most transactions settled per chunk
+        load:           callable returning the number of requests in flight
+        max_load:       back off while load() is above this
+        poll_interval:  seconds between checks of the store size and of stop()
+        backoff:        first back-off delay, doubled up to max_backoff
+        """
+        threading.Thread.__init__(self, name="settlement-scheduler", daemon=True)
+        self.interval = interval
+        self.size_threshold = size_threshold
+        self.chunk_size = chunk_size
+        self.load = load or (lambda: 0)
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._status = {
+            "state": "idle",
+            "sweeps": 0,
+            "chunks": 0,
+            "settled": 0,
+            "rejected": 0,
+            "backoffs": 0,
+            "last_settlement_id": None,
+            "last_sweep_started": None,
+            "last_sweep_finished": None,
+            "last_error": None,
+        }
+
+    def _update(self, **changes):
+        with self._lock:
+            self._status.update(changes)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._status[name] += amount
+
+    def status(self):
+        """Returns a snapshot of the scheduler's progress"""
+        with self._lock:
+            result = dict(self._status)
+        result["pending"] = datastore.size()
+        result["interval"] = self.interval
+        result["size_threshold"] = self.size_threshold
+        result["chunk_size"] = self.chunk_size
+        return result
+
+    def stop(self):
+        """Stops after the current chunk"""
+        self._stop_event.set()
+
+    def _wait_for_capacity(self):
+        """Waits while the service is busy; returns False if stopped meanwhile"""
+        delay = self.backoff
+        while self.load() > self.max_load:
+            self._update(state="backing off")
+            self._count("backoffs")
+            if self._stop_event.wait(delay):
+                return False
+            delay = min(delay * 2, self.max_backoff)
+        return True
+
+    def settle_chunk(self):
+        """Settles up to chunk_size of the oldest unsettled transactions; returns how many"""
+        chunk = datastore.get_unsettled(self.chunk_size)
+        if not chunk:
+            return 0
+        settlement = CCSettlement.settle([CCTransaction.from_dict(t) for t in chunk])
+        self._count("chunks")
+        self._count("settled", len(settlement.transactions))
+        self._count("rejected", len(settlement.unsettled))
+        if settlement.transactions:
+            self._update(last_settlement_id=settlement.settlement_id)
+        logging.info("Auto-settlement %s: %d settled, %d rejected\n", settlement.settlement_id,
+                     len(settlement.transactions), len(settlement.unsettled))
+        return len(chunk)
+
+    def sweep(self):
+        """Settles everything that was unsettled when the sweep started"""
+        self._update(state="sweeping", last_sweep_started=time.time())
+        self._count("sweeps")
+        remaining = datastore.size()
+        while remaining > 0 and not self._stop_event.is_set():
+            if not self._wait_for_capacity():
+                break
+            self._update(state="sweeping")
+            taken = self.settle_chunk()
+            if taken == 0:
+                break
+            remaining -= taken
+        self._update(state="idle", last_sweep_finished=time.time())
+
+    def run(self):
+        next_sweep = time.monotonic() + self.interval if self.interval else None
+        while not self._stop_event.wait(self.poll_interval):
+            due = next_sweep is not None and time.monotonic() >= next_sweep
+            full = self.size_threshold and datastore.size() >= self.size_threshold
+            if not (due or full):
+                continue
+            try:
+                self.sweep()
+            except Exception as err:   # keep the worker alive for the next sweep
+                logging.exception("Auto-settlement sweep failed")
+                self._update(state="idle", last_error=str(err))
+            if self.interval:
+                next_sweep = time.monotonic() + self.interval
+        self._update(state="stopped")
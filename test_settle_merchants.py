@@ -0,0 +1,51 @@
+"""
+   Author: M I Schwartz
+   Tests a settlement partitioned by merchant, against a service
+   started the way it is run: python3 credit_card_validation_service.py
+   (port 8000 must be free)
+"""
+from cc_transaction import *
+
+import subprocess
+import sys
+import time
+
+import requests
+
+url = "http://localhost:8000/api/validate"
+murl = "http://localhost:8000/api/settle/merchants"
+
+service = subprocess.Popen([sys.executable, "credit_card_validation_service.py"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+try:
+    # Wait for the service to listen
+    for attempt in range(50):
+        try:
+            requests.get("http://localhost:8000/hello")
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    else:
+        print("Service did not start")
+        exit()
+
+    # Authorize transactions for two merchants
+    my_transactions = []
+    for i in range(0,6):
+        my_transaction = CCTransaction("ICT4310 Instructor", "4140-1233-3445-4561",
+                                       "123", "12", "2028", "usd")
+        my_transaction.set_amount(10000 + i * 105)
+        my_transaction.set_merchant_data("Target", "merch_%d" % (i % 2))
+        validated_transaction = requests.post(url, data=my_transaction.to_json())
+        my_transactions.append(my_transaction.update_from_json(validated_transaction.text))
+
+    # Settle twice: the second call must be served too, and finds nothing outstanding
+    for attempt in range(2):
+        settled = requests.post(murl, data=CCTransaction.list_to_json(my_transactions))
+        print("Status " + str(settled.status_code) + ": " +
+              ", ".join(s["network_id"] + " settled " + str(len(s["transactions"])) +
+                        " unsettled " + str(len(s["unsettled"]))
+                        for s in settled.json()["settlements"]))
+finally:
+    service.terminate()
+    service.wait()
@@ -0,0 +1,146 @@
+"""
+   Author: M I Schwartz
+   Tests the failure codes settle gives each transaction it does not settle,
+   and that a batch the archive cannot record is put back (no service needed)
+"""
+import copy
+import datetime
+import errno
+import logging
+import tempfile
+import uuid
+
+import datastore
+
+from cc_settlement import CCSettlement
+from cc_transaction import CCTransaction
+from settlement_archive import SettlementArchive
+
+VISA = "4140-1233-3445-4561"
+
+
+class FailingArchive(SettlementArchive):
+    """An archive whose disk fills up for the next `failures` appends"""
+    failures = 0
+
+    def append(self, settlement):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return super().append(settlement)
+
+
+def authorized(index, **extra):
+    """Stores an approved authorization; returns the transaction the merchant holds"""
+    transaction = CCTransaction("Test Holder", VISA, "123", "12",
+                                str(datetime.date.today().year + 2), "usd")
+    transaction.set_amount(1000 + index)
+    transaction.set_merchant_data("Test Merchant", "merch_%d" % (index % 3))
+    transaction.data["card"]["valid"] = True
+    transaction.data["card"]["type"] = "visa"
+    transaction.data["approved"] = True
+    transaction.data["authorized"] = True
+    transaction.data["failure_code"] = ""
+    transaction.data["failure_message"] = ""
+    transaction.data["approval_code"] = "appr_" + str(uuid.uuid4())
+    transaction.data.update(extra)
+    datastore.store(copy.deepcopy(transaction.data))
+    return transaction
+
+
+def claim(transaction):
+    """A separate copy of the transaction, as sent back by the merchant"""
+    return CCTransaction.from_dict(copy.deepcopy(transaction.data))
+
+
+def codes(result):
+    """The failure code of each unsettled transaction, in order"""
+    return [transaction.data["failure_code"] for transaction in result.unsettled]
+
+
+failures = 0
+checks = 0
+
+
+def check(name, actual, expected):
+    global failures, checks
+    checks += 1
+    if actual != expected:
+        failures += 1
+        print("%s: got %r, expected %r" % (name, actual, expected))
+
+
+# The archive failures below are expected; settle logs each one
+logging.disable(logging.ERROR)
+
+with tempfile.TemporaryDirectory() as directory:
+    CCSettlement.archive = FailingArchive(directory)
+
+    # 404: an approval code the datastore never issued
+    unknown = authorized(1)
+    unknown.data["approval_code"] = "appr_" + str(uuid.uuid4())
+    result = CCSettlement.settle([claim(unknown)])
+    check("unknown approval code", codes(result), [404])
+
+    # 406: the claimed amount differs from the authorized one
+    tampered = authorized(2)
+    changed = claim(tampered)
+    changed.set_amount(999999)
+    result = CCSettlement.settle([changed])
+    check("changed amount", codes(result), [406])
+    check("changed amount leaves the authorization",
+          tampered.data["approval_code"] in datastore.get_unsettled_keys(), True)
+    result = CCSettlement.settle([claim(tampered)])
+    check("unchanged amount", (codes(result), len(result.transactions)), ([], 1))
+
+    # 409: the same approval code twice in one batch; the first settles
+    twice = authorized(3)
+    result = CCSettlement.settle([claim(twice), claim(twice)])
+    check("repeated approval code", codes(result), [409])
+    check("repeated approval code settles once", len(result.transactions), 1)
+
+    # 410: settling again once the archive has the approval code
+    result = CCSettlement.settle([claim(twice)])
+    check("settled again", codes(result), [410])
+
+    # 412: the authorization expired before settlement
+    now = [1000.0]
+    datastore.set_expiry(lambda transaction: 10, tick=1, clock=lambda: now[0])
+    late = authorized(4)
+    now[0] += 60
+    result = CCSettlement.settle([claim(late)])
+    check("expired authorization", codes(result), [412])
+    datastore.set_expiry(None)
+
+    # 503: the archive cannot record the batch, which goes back in the datastore
+    batch = [authorized(5 + i) for i in range(3)]
+    size = datastore.size()
+    CCSettlement.archive.failures = 1
+    result = CCSettlement.settle([claim(transaction) for transaction in batch])
+    check("archive failure", codes(result), [503] * 3)
+    check("archive failure settles nothing", len(result.transactions), 0)
+    check("archive failure settlement id", result.settlement_id, "pending")
+    check("archive failure restores the batch", datastore.size(), size)
+    check("archive failure leaves no settlement id",
+          [transaction.data.get("settlement_id") for transaction in result.unsettled],
+          [None] * 3)
+    for transaction in batch:
+        check("archive failure is not recorded",
+              CCSettlement.archive.is_settled(transaction.data["approval_code"]), False)
+
+    # ... and settling the same batch again works
+    result = CCSettlement.settle([claim(transaction) for transaction in batch])
+    check("retry after archive failure", (codes(result), len(result.transactions)), ([], 3))
+    check("retry empties the datastore", datastore.size(), size - 3)
+
+    # 503 also when the archive cannot encode the stored data
+    odd = authorized(8, note=b"\x00")
+    size = datastore.size()
+    result = CCSettlement.settle([claim(odd)])
+    check("unencodable transaction", codes(result), [503])
+    check("unencodable transaction is restored", datastore.size(), size)
+
+    CCSettlement.archive = None
+
+print("There are " + str(checks - failures) + " passing checks and " +
+      str(failures) + " failures")
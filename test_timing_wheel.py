@@ -0,0 +1,79 @@
+"""
+   Author: M I Schwartz
+   Tests the timing wheel against a brute force list of deadlines,
+   with random schedules, cancels and advances (no service needed)
+"""
+import math
+import random
+
+from timing_wheel import TimingWheel
+
+
+def brute_expired(deadlines, target):
+    """The keys a wheel moved on to tick target must expire"""
+    return {key for key, due in deadlines.items() if due <= target}
+
+
+def run(seed, tick, slots, levels, steps=2000):
+    rng = random.Random(seed)
+    now = rng.uniform(0, 1000)
+    wheel = TimingWheel(tick, slots, levels, now)
+    deadlines = {}                   # key -> due tick
+    current = int(now / tick)
+    span = slots ** levels
+    for step in range(steps):
+        action = rng.random()
+        if action < 0.5:
+            key = rng.randrange(500)
+            # Near, far and beyond the wheel's span, sometimes in the past
+            delay = rng.choice([rng.uniform(-tick, 3 * tick),
+                                rng.uniform(0, slots * tick),
+                                rng.uniform(0, span * tick),
+                                rng.uniform(span * tick, 3 * span * tick)])
+            wheel.schedule(key, now + delay)
+            deadlines[key] = max(int(math.ceil((now + delay) / tick)), current + 1)
+        elif action < 0.6:
+            key = rng.randrange(500)
+            if wheel.cancel(key) != (key in deadlines):
+                return "cancel(%r) disagrees at step %d" % (key, step)
+            deadlines.pop(key, None)
+        else:
+            now += rng.choice([rng.uniform(0, 2 * tick),
+                               rng.uniform(0, slots * tick),
+                               rng.uniform(0, slots * slots * tick)])
+            target = int(now / tick)
+            expected = brute_expired(deadlines, target)
+            expired = wheel.advance(now)
+            if len(expired) != len(set(expired)) or set(expired) != expected:
+                return "advance to tick %d at step %d: expired %d, expected %d" % (
+                    target, step, len(expired), len(expected))
+            for key in expected:
+                del deadlines[key]
+            current = target
+        if len(wheel) != len(deadlines):
+            return "size %d, expected %d at step %d" % (len(wheel), len(deadlines), step)
+    return None
+
+
+failures = 0
+runs = 0
+for levels in (2, 3, 4):
+    for slots in (2, 3, 8, 16):
+        for tick in (1.0, 0.25):
+            for seed in range(5):
+                runs += 1
+                problem = run(seed, tick, slots, levels)
+                if problem:
+                    failures += 1
+                    print("levels=%d slots=%d tick=%s seed=%d: %s" %
+                          (levels, slots, tick, seed, problem))
+
+try:
+    TimingWheel(levels=1)
+    print("levels=1 was accepted")
+    failures += 1
+except ValueError:
+    pass
+
+print("There are " + str(runs - failures) + " passing runs and " +
+      str(failures) + " failures")
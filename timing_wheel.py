@@ -0,0 +1,120 @@
+"""
+   Author: M I Schwartz
+
+   A hierarchical timing wheel, for expiring authorizations from the
+   unsettled store without scanning it.
+
+   * Time is counted in ticks of `tick` seconds
+   * Level 0 has one slot per tick for the next `slots` ticks; each higher
+       level has slots `slots` times as wide. An entry goes in the lowest level
+       whose span covers its deadline
+   * As time passes, the level 0 slot for each tick expires, and whenever
+       a level wraps around, the current slot of the level above is cascaded:
+       its entries are placed again, now in a lower level
+   * Adding, cancelling and expiring are O(1); each entry is cascaded at most
+       once per level, so the total work per entry is O(levels)
+   * While the lower levels are empty, advance jumps straight to the next
+       tick at which a higher level cascades, so a long idle stretch costs
+       O(levels) steps rather than one per tick
+   * Deadlines beyond the top level are held in its farthest slot and placed
+       again when it cascades, so there must be at least two levels
+"""
+
+import math
+
+DEFAULT_SLOTS = 64
+DEFAULT_LEVELS = 4
+
+
+class TimingWheel:
+    """Keys with deadlines (seconds, on any clock); advance(now) returns the expired keys"""
+
+    def __init__(self, tick=1.0, slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS, now=0.0):
+        if levels < 2 or slots < 2:
+            # One level never cascades: far deadlines would expire with its farthest slot
+            raise ValueError("A timing wheel needs at least 2 levels of at least 2 slots")
+        self.tick = float(tick)
+        self.slots = slots
+        self.levels = levels
+        self.current = int(now / self.tick)   # the last tick expired
+        self.span = slots ** levels            # ticks covered by the whole wheel
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where = {}                       # key -> (level, the slot dict holding it)
+        self._counts = [0] * levels            # entries held in each level
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, deadline):
+        """Expires key at deadline (replacing any deadline it had)"""
+        self.cancel(key)
+        self._place(key, max(int(math.ceil(deadline / self.tick)), self.current + 1))
+
+    def cancel(self, key):
+        """Forgets key; True if it was scheduled"""
+        where = self._where.pop(key, None)
+        if where is None:
+            return False
+        level, slot = where
+        del slot[key]
+        self._counts[level] -= 1
+        return True
+
+    def _place(self, key, due):
+        placed = min(due, self.current + self.span - 1)
+        delta = placed - self.current
+        level = 0
+        width = 1
+        while delta >= width * self.slots and level < self.levels - 1:
+            level += 1
+            width *= self.slots
+        slot = self._wheels[level][(placed // width) % self.slots]
+        slot[key] = due
+        self._where[key] = (level, slot)
+        self._counts[level] += 1
+
+    def _cascade(self, level):
+        """Places the entries of level's current slot again; True if the level wrapped"""
+        index = (self.current // self.slots ** level) % self.slots
+        slot = self._wheels[level][index]
+        if slot:
+            self._wheels[level][index] = {}
+            self._counts[level] -= len(slot)
+            for key, due in slot.items():
+                self._place(key, due)
+        return index == 0
+
+    def advance(self, now):
+        """Moves the wheel on to now; returns the keys whose deadline has passed"""
+        target = int(now / self.tick)
+        expired = []
+        while self.current < target:
+            if not self._where:
+                self.current = target
+                break
+            # Nothing happens before the next cascade of the lowest level holding
+            # entries (level L cascades on ticks that are multiples of slots ** L)
+            lowest = 0
+            while not self._counts[lowest]:
+                lowest += 1
+            if lowest:
+                period = self.slots ** lowest
+                self.current = min(target, (self.current // period + 1) * period - 1)
+                if self.current == target:
+                    break
+            self.current += 1
+            if self.current % self.slots == 0:
+                level = 1
+                while level < self.levels and self._cascade(level):
+                    level += 1
+            slot = self._wheels[0][self.current % self.slots]
+            if slot:
+                self._wheels[0][self.current % self.slots] = {}
+                self._counts[0] -= len(slot)
+                for key in slot:
+                    del self._where[key]
+                expired.extend(slot)
+        return expired
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+   Author: M I Schwartz
+
+   TLS benchmark for the HTTPS listener.
+
+   Measures, against the TLSHTTPServer from credit_card_validation_service:
+    * full handshakes per second (a new session on every connection)
+    * resumed handshakes per second (the previous connection's session is offered)
+    * requests per second on one keep-alive connection
+
+   Each handshake is followed by one GET /hello so that TLS 1.3 session
+   tickets (sent after the handshake) reach the client.
+
+   By default the server is started in this process on a free port with the
+   certificate made by create_pem.sh (localhost.pem); use --host/--port to
+   measure a service that is already running.
+
+   Usage::
+       sh create_pem.sh
+       python3 tls_benchmark.py --connections 500
+       python3 tls_benchmark.py --port 8443 --concurrency 4
+"""
+
+import argparse
+import json
+import logging
+import socket
+import ssl
+import sys
+import threading
+import time
+
+from credit_card_validation_service import (HTTPRequestHandler, TLSHTTPServer,
+                                            cc_tls_pem_file, make_tls_context)
+
+REQUEST = b"GET /hello HTTP/1.1\r\nHost: localhost\r\n\r\n"
+
+
+class QuietHandler(HTTPRequestHandler):
+    """The access log would dominate the measurement"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+def client_context(cafile=None):
+    """Client context; the self-signed certificate is not verified unless cafile is given"""
+    if cafile:
+        return ssl.create_default_context(cafile=cafile)
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def read_response(connection):
+    """Reads one response; /hello always sends a Content-Length"""
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = connection.recv(4096)
+        if not chunk:
+            raise ConnectionError("Connection closed by the service")
+        data += chunk
+    head, _, body = data.partition(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    while len(body) < length:
+        body += connection.recv(4096)
+
+
+def handshakes(host, port, context, count, resume):
+    """Opens `count` connections; returns (elapsed seconds, connections that resumed)"""
+    session = None
+    reused = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        raw = socket.create_connection((host, port))
+        connection = context.wrap_socket(raw, server_hostname="localhost",
+                                         session=session if resume else None)
+        connection.sendall(REQUEST)
+        read_response(connection)
+        if connection.session_reused:
+            reused += 1
+        if resume:
+            session = connection.session
+        connection.close()
+    return time.perf_counter() - start, reused
+
+
+def keep_alive_requests(host, port, context, count):
+    """Sends `count` requests on one connection; returns elapsed seconds"""
+    connection = context.wrap_socket(socket.create_connection((host, port)),
+                                     server_hostname="localhost")
+    start = time.perf_counter()
+    for _ in range(count):
+        connection.sendall(REQUEST)
+        read_response(connection)
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed
+
+
+def in_parallel(concurrency, func, *args):
+    """Runs func(*args) on `concurrency` threads; returns the wall time and the results"""
+    results = [None] * concurrency
+
+    def target(index):
+        results[index] = func(*args)
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, results
+
+
+def run(host, port, connections, requests_per_connection, concurrency, cafile=None):
+    context = client_context(cafile)
+    per_thread = max(1, connections // concurrency)
+    total = per_thread * concurrency
+    report = {"connections": total, "concurrency": concurrency}
+
+    for mode, resume in (("full", False), ("resumed", True)):
+        elapsed, results = in_parallel(concurrency, handshakes, host, port, context,
+                                       per_thread, resume)
+        reused = sum(result[1] for result in results)
+        report[mode + "_handshakes_per_second"] = total / elapsed
+        report[mode + "_sessions_reused"] = reused
+
+    elapsed, _ = in_parallel(concurrency, keep_alive_requests, host, port, context,
+                             requests_per_connection)
+    report["keep_alive_requests_per_second"] = requests_per_connection * concurrency / elapsed
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TLS handshake and request benchmark")
+    parser.add_argument("--pem", default=cc_tls_pem_file,
+                        help="key and certificate made by create_pem.sh")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int,
+                        help="benchmark a running service instead of an in-process server")
+    parser.add_argument("--connections", type=int, default=200,
+                        help="connections per handshake mode")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="requests per keep-alive connection")
+    parser.add_argument("--concurrency", type=int, default=1, help="client threads")
+    parser.add_argument("--cafile", help="verify the server certificate against this file")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    httpd = None
+    port = args.port
+    if port is None:
+        httpd = TLSHTTPServer(("localhost", 0), QuietHandler, make_tls_context(args.pem))
+        port = httpd.server_address[1]
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    try:
+        report = run(args.host, port, args.connections, args.requests,
+                     args.concurrency, args.cafile)
+    finally:
+        if httpd:
+            httpd.shutdown()
+            httpd.server_close()
+
+    print("connections per mode:        %d (concurrency %d)" %
+          (report["connections"], report["concurrency"]))
+    print("full handshakes/s:           %.1f" % report["full_handshakes_per_second"])
+    print("resumed handshakes/s:        %.1f  (%d sessions reused)" %
+          (report["resumed_handshakes_per_second"], report["resumed_sessions_reused"]))
+    print("keep-alive requests/s:       %.1f" % report["keep_alive_requests_per_second"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
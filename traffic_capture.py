@@ -0,0 +1,249 @@
+"""
+   Author: M I Schwartz
+
+   Capture of the service's API traffic, for deterministic replay (replay.py).
+
+   HTTPRequestHandler hands each POST to TrafficCapture.record, which only
+   queues it; a writer thread decodes the bodies, tokenizes card data and
+   appends the record, so capturing adds little to the request's latency.
+   If the writer falls behind by max_queue records, records are dropped and
+   counted rather than slowing the service down.
+
+   Tokenization keeps what the service's decisions depend on:
+    * a PAN keeps its BIN (first six digits), its last four digits, its length,
+      its separators and whether it passes the Luhn check; the digits between
+      are a keyed hash, so one card always gets the same token
+    * a card_code keeps its length, and is a keyed hash of the card and the code
+   tokenize_card_book applies the same tokens to an enrolled card book, so a
+   replay server can authorize the tokenized cards as the original did.
+
+   The file is gzip-compressed JSON lines, flushed as it goes (a capture cut
+   short by a kill is readable up to its last flush):
+       {"format": "cc-capture", "version": 1, "started": epoch-seconds}
+       {"t": seconds-after-start, "method": "POST", "path": "/api/validate",
+        "content_type": ..., "accept": ..., "content_encoding": ...,
+        "request": decoded-body, "status": 200, "response": decoded-body,
+        "latency": seconds}
+   A body that is not JSON or MessagePack is kept as "request_text" or
+   "response_text" instead; a streamed response is kept as null.
+"""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import wire_format
+
+FORMAT = "cc-capture"
+VERSION = 1
+DEFAULT_MAX_QUEUE = 10000
+FLUSH_INTERVAL = 1.0   # seconds between flushes of the capture file
+
+_PAN = re.compile(r'(?<![\w-])\d(?:[ -]?\d){12,18}(?![\w-])')
+_NON_DIGITS = re.compile(r'[\D]')
+
+
+def luhn_valid(digits):
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if position % 2 == 1:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+class Tokenizer:
+    """Keyed, format preserving tokens for PANs and card codes"""
+
+    def __init__(self, key=None):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        self.key = key or os.urandom(32)
+
+    def _hash_digits(self, text, count):
+        digest = hmac.new(self.key, text.encode("utf-8"), hashlib.sha256).digest()
+        return str(int.from_bytes(digest, "big") % 10 ** count).zfill(count)
+
+    def pan(self, value):
+        """The token for a PAN; strings that are not 13 to 19 digits are returned as they are"""
+        digits = _NON_DIGITS.sub('', value)
+        if not 13 <= len(digits) <= 19:
+            return value
+        middle = self._hash_digits("pan:" + digits, len(digits) - 10)
+        valid = luhn_valid(digits)
+        # The last digit of the middle is chosen so the token passes (or fails)
+        # the Luhn check just as the PAN did
+        for adjust in range(10):
+            candidate = digits[:6] + middle[:-1] + str((int(middle[-1]) + adjust) % 10) + digits[-4:]
+            if luhn_valid(candidate) == valid:
+                break
+        replacement = iter(candidate)
+        return "".join(next(replacement) if char.isdigit() else char for char in value)
+
+    def card_code(self, pan, code):
+        code = str(code)
+        if not code.isdigit():
+            return code
+        return self._hash_digits("code:" + _NON_DIGITS.sub('', str(pan)) + ":" + code, len(code))
+
+    def text(self, value):
+        """Tokenizes anything that looks like a PAN in free text"""
+        return _PAN.sub(lambda match: self.pan(match.group(0)), value)
+
+    def tokenize(self, data):
+        """Returns a copy of decoded request or response data with the card data tokenized"""
+        if isinstance(data, dict):
+            result = {}
+            for key, value in data.items():
+                if key == "card" and isinstance(value, dict):
+                    result[key] = self.card(value)
+                else:
+                    result[key] = self.tokenize(value)
+            return result
+        if isinstance(data, list):
+            return [self.tokenize(item) for item in data]
+        if isinstance(data, str):
+            return self.text(data)
+        return data
+
+    def card(self, card):
+        """Tokenizes a card info structure (or an enrolled card book entry)"""
+        result = dict(card)
+        pan = str(card.get("id", ""))
+        for key, value in card.items():
+            if key == "id":
+                result[key] = self.pan(pan)
+            elif key == "card_code":
+                result[key] = self.card_code(pan, value)
+            else:
+                result[key] = self.tokenize(value)
+        return result
+
+
+def tokenize_card_book(source, destination, key):
+    """Writes a copy of an enrolled card book (ccstore) with the cards tokenized"""
+    tokenizer = Tokenizer(key)
+    with open(source) as f:
+        book = json.load(f)
+    with open(destination, "w") as f:
+        json.dump([tokenizer.card(card) for card in book], f, indent=2)
+
+
+def _decode(content_type, body):
+    """Returns (data, text): the decoded body, or its text if it is not JSON or MessagePack"""
+    if body is None:
+        return None, None
+    if wire_format.is_msgpack(content_type):
+        try:
+            return wire_format.unpackb(body), None
+        except ValueError:
+            return None, repr(body)
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    try:
+        return json.loads(body), None
+    except ValueError:
+        return None, body
+
+
+class TrafficCapture:
+    """Appends captured requests to a capture file from a writer thread"""
+
+    def __init__(self, path, token_key=None, max_queue=DEFAULT_MAX_QUEUE):
+        self.path = path
+        self.tokenizer = Tokenizer(token_key)
+        self.started = time.time()
+        self.captured = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._file.write(json.dumps({"format": FORMAT, "version": VERSION,
+                                     "started": self.started}) + "\n")
+        self._file.flush()
+        self._writer = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+        self._writer.start()
+
+    def record(self, arrival, latency, method, path, headers, request_body,
+               status, response_content_type, response_body):
+        """
+        Queues one request: arrival is its time.time(), latency in seconds,
+        request_body the bytes read (after any gzip), response_body the str or
+        bytes sent, or None if it was streamed.
+        """
+        item = (arrival - self.started, latency, method, path,
+                headers.get("Content-Type"), headers.get("Accept"),
+                headers.get("Content-Encoding"), request_body,
+                status, response_content_type, response_body)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                try:
+                    self._file.write(json.dumps(self._to_record(item)) + "\n")
+                    self.captured += 1
+                except (TypeError, ValueError) as err:
+                    logging.warning("Cannot capture request: %s\n", err)
+            if time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                self._file.flush()
+                last_flush = time.monotonic()
+        self._file.close()
+
+    def _to_record(self, item):
+        (offset, latency, method, path, content_type, accept, content_encoding,
+         request_body, status, response_content_type, response_body) = item
+        record = {"t": round(offset, 6), "method": method, "path": path,
+                  "content_type": content_type, "accept": accept,
+                  "content_encoding": content_encoding,
+                  "status": status, "latency": round(latency, 6)}
+        for name, kind, body in (("request", content_type, request_body),
+                                 ("response", response_content_type, response_body)):
+            data, text = _decode(kind, body)
+            if text is not None:
+                record[name + "_text"] = self.tokenizer.text(text)
+            else:
+                record[name] = self.tokenizer.tokenize(data)
+        return record
+
+    def close(self):
+        """Writes out what is queued and closes the file"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+
+def read_capture(path):
+    """Yields the records of a capture file (the header is checked, not yielded)"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            header = json.loads(f.readline())
+            if header.get("format") != FORMAT:
+                raise ValueError("%s is not a capture file" % path)
+            for line in f:
+                if not line.endswith("\n"):
+                    return   # the last record was cut short
+                if line.strip():
+                    yield json.loads(line)
+        except EOFError:
+            # The capture was cut short; everything flushed so far is good
+            return
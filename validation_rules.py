@@ -0,0 +1,253 @@
+"""
+    Author: M I Schwartz
+
+    Configurable validation and authorization rules for CCTransaction.
+
+    * Rule is one check with the failure code and message it reports,
+        and counters of calls, rejections and time spent
+    * RulePipeline runs a list of rules in order and stops at the first
+        rejection; it is built once and reused for every transaction. A rule
+        with side effects (velocity counting) gives an undo, called if a later
+        rule rejects the transaction
+    * DayContext holds the per-day values used by the expiry rule
+        (today's month key), so a date is not built for every transaction
+    * default_validation_rules and default_authorization_rules reproduce the
+        checks of CCTransaction.validate_transaction and authorize_transaction
+
+    Rules are checked as check(data, context) where data is the transaction
+    dict and context is a per-run dict holding the parsed "amount" (None if it
+    is missing or not a number). Since rules are reordered by rejection rate,
+    each check copes with missing or malformed fields itself (rejecting the
+    transaction) rather than relying on an earlier rule to have caught them.
+    The counters are not locked, so under concurrent requests they are
+    approximate; they are meant for tuning rule order by rejection rate.
+"""
+
+import datetime
+import re
+import time
+
+import validation_utilities
+
+DEFAULT_MAX_AMOUNT = 500000
+DEFAULT_MAX_FUTURE_YEARS = 5
+
+_NON_DIGITS = re.compile(r'[\D]')
+_VENDORS = [(vendor, re.compile(pattern))
+            for vendor, pattern in validation_utilities.cc_dictionary.items()]
+
+
+class Rule:
+    """A single check with its failure code, message and counters"""
+
+    def __init__(self, name, failure_code, failure_message, check, status_field="approved",
+                 undo=None):
+        """
+        check(data, context) returns True if the transaction passes.
+        status_field is set to False on the transaction when the rule rejects it.
+        undo(data, context), if given, reverses what a passing check did
+        when a later rule rejects the transaction.
+        """
+        self.name = name
+        self.failure_code = failure_code
+        self.failure_message = failure_message
+        self.check = check
+        self.status_field = status_field
+        self.undo = undo
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.rejections = 0
+        self.seconds = 0.0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "failure_code": self.failure_code,
+            "calls": self.calls,
+            "rejections": self.rejections,
+            "rejection_rate": self.rejections / self.calls if self.calls else 0.0,
+            "mean_us": self.seconds / self.calls * 1e6 if self.calls else 0.0,
+        }
+
+
+class RulePipeline:
+    """An ordered, short-circuiting list of rules"""
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+
+    def run(self, data):
+        """
+        Runs the rules in order; on the first rejection, undoes the rules that
+        passed, marks the transaction with the rule's failure code and message
+        and returns the rule. Returns None if every rule passes.
+        """
+        context = {"amount": _parse_amount(data.get("amount"))}
+        clock = time.perf_counter
+        for position, rule in enumerate(self.rules):
+            start = clock()
+            passed = rule.check(data, context)
+            rule.seconds += clock() - start
+            rule.calls += 1
+            if not passed:
+                rule.rejections += 1
+                for passed_rule in reversed(self.rules[:position]):
+                    if passed_rule.undo is not None:
+                        passed_rule.undo(data, context)
+                data[rule.status_field] = False
+                data["failure_code"] = rule.failure_code
+                data["failure_message"] = rule.failure_message
+                return rule
+        return None
+
+    def stats(self):
+        """Per-rule counters, in pipeline order"""
+        return [rule.stats() for rule in self.rules]
+
+    def reset(self):
+        for rule in self.rules:
+            rule.reset()
+
+
+class DayContext:
+    """Date values for the expiry check, recomputed only when the day changes"""
+
+    def __init__(self):
+        self.valid_until = 0.0
+        self.refresh()
+
+    def refresh(self):
+        now = time.time()
+        if now < self.valid_until:
+            return self
+        today = datetime.date.today()
+        self.year = today.year
+        self.month_key = today.year * 12 + today.month
+        # A card expires on the 28th of its month
+        self.before_28th = today.day < 28
+        tomorrow = datetime.datetime.combine(today + datetime.timedelta(days=1),
+                                             datetime.time())
+        self.valid_until = tomorrow.timestamp()
+        return self
+
+
+def _parse_amount(amount):
+    try:
+        return int(amount)
+    except (TypeError, ValueError):
+        return None
+
+
+def card_of(data):
+    """The transaction's card info, or an empty dict if it has none"""
+    card = data.get("card")
+    return card if isinstance(card, dict) else {}
+
+
+def check_card_format(data, context):
+    """Vendor format, Luhn and CVV length; records the card's validity and vendor"""
+    card = data.get("card")
+    if not isinstance(card, dict):
+        return False
+    number = _NON_DIGITS.sub('', str(card.get("id", "")))
+    vendor = False
+    for name, pattern in _VENDORS:
+        if pattern.fullmatch(number):
+            vendor = name
+            break
+    valid = bool(vendor) and validation_utilities.verify_luhn(number)
+    if valid:
+        cvv_length = 4 if vendor == "amex" else 3
+        valid = len(str(card.get("card_code", ""))) == cvv_length
+    card["valid"] = valid
+    card["type"] = vendor
+    return valid
+
+
+def check_required_fields(data, context):
+    """The same test as CCTransaction.is_ready_for_request"""
+    card = data.get("card")
+    merchant_data = data.get("merchant_data")
+    return "id" in data and isinstance(card, dict) and \
+        "id" in card and "name" in card and "currency" in card and \
+        "exp_month" in card and "exp_year" in card and "card_code" in card and \
+        isinstance(merchant_data, dict) and \
+        "name" in merchant_data and "network_id" in merchant_data and \
+        context["amount"] is not None and context["amount"] > 0
+
+
+def amount_range_check(max_amount=DEFAULT_MAX_AMOUNT):
+    def check_amount_range(data, context):
+        return context["amount"] is not None and 0 <= context["amount"] <= max_amount
+    return check_amount_range
+
+
+def expiry_check(max_future_years=DEFAULT_MAX_FUTURE_YEARS, day=None):
+    """The same test as validation_utilities.validate_date, against a DayContext"""
+    day = day or DayContext()
+
+    def check_expiry(data, context):
+        today = day.refresh()
+        card = card_of(data)
+        try:
+            year = int(card["exp_year"])
+            month = int(card["exp_month"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        # validate_date rejects these as datetime.date does
+        if not 1 <= month <= 12:
+            return False
+        month_key = year * 12 + month
+        if month_key < today.month_key or \
+           (month_key == today.month_key and not today.before_28th):
+            return False
+        return year - today.year < max_future_years
+    return check_expiry
+
+
+def default_validation_rules(max_amount=DEFAULT_MAX_AMOUNT,
+                             max_future_years=DEFAULT_MAX_FUTURE_YEARS):
+    """The checks of CCTransaction.validate_transaction, in their original order"""
+    return [
+        Rule("card_format", 401, "Card is not valid", check_card_format),
+        Rule("required_fields", 402, "Missing information for transaction approval",
+             check_required_fields),
+        Rule("amount_range", 405, "Transaction amount threshold exceeded",
+             amount_range_check(max_amount)),
+        Rule("expiry", 408, "Invalid expiration date", expiry_check(max_future_years)),
+    ]
+
+
+def default_authorization_rules():
+    """The enrolled-account checks of CCTransaction.authorize_transaction"""
+    import ccstore
+
+    def customer_of(data, context):
+        """The card's enrolled customer_id (None if not enrolled), looked up once per run"""
+        if "customer_id" not in context:
+            card_id = card_of(data).get("id")
+            context["customer_id"] = ccstore.cc_get_customer_id(card_id) \
+                if isinstance(card_id, str) else None
+        return context["customer_id"]
+
+    def check_enrolled(data, context):
+        return customer_of(data, context) is not None
+
+    def check_card_code(data, context):
+        customer_id = customer_of(data, context)
+        return customer_id is not None and \
+            ccstore.cc_check_code(customer_id, card_of(data).get("card_code"))
+
+    def check_account_limit(data, context):
+        customer_id = customer_of(data, context)
+        return customer_id is not None and context["amount"] is not None and \
+            context["amount"] < int(ccstore.cc_get_limit(customer_id))
+
+    return [
+        Rule("enrolled", 401, "Credit card account not found", check_enrolled, "authorized"),
+        Rule("card_code", 411, "Card code incorrect", check_card_code, "authorized"),
+        Rule("account_limit", 405, "Account threshold exceeded", check_account_limit,
+             "authorized"),
+    ]
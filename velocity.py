@@ -0,0 +1,233 @@
+"""
+   Author: M I Schwartz
+
+   Sliding-window velocity checks: how many authorizations, and how much,
+   per card and per merchant over recent windows.
+
+   * VelocityLimit is one window: at most max_count authorizations and
+       max_amount (lowest denomination) within window seconds
+   * SlidingWindow counts one key against one limit with a fixed ring of
+       time buckets; recording and checking are O(1) amortized and the memory
+       per key is fixed
+   * VelocityTracker keeps the windows for every card and merchant seen,
+       evicting keys that have been idle longer than the longest window,
+       and at most max_keys of them (least recently used first)
+   * velocity_rules returns authorization Rules for CCTransaction; the
+       first of them to run checks both limits and records the authorization
+       under one lock, and the record is undone if a later rule rejects
+"""
+
+import collections
+import re
+import threading
+import time
+
+from validation_rules import Rule, card_of
+
+CARD_VELOCITY_FAILURE = 421
+MERCHANT_VELOCITY_FAILURE = 422
+
+DEFAULT_MAX_KEYS = 100000
+DEFAULT_BUCKETS = 10
+
+_NON_DIGITS = re.compile(r'[\D]')
+
+
+class VelocityLimit:
+    """At most max_count authorizations and max_amount within window seconds; None is unlimited"""
+
+    def __init__(self, window, max_count=None, max_amount=None, buckets=DEFAULT_BUCKETS):
+        self.window = float(window)
+        self.max_count = max_count
+        self.max_amount = max_amount
+        self.buckets = buckets
+        self.bucket_width = self.window / buckets
+
+
+class SlidingWindow:
+    """Counts and amounts in a ring of time buckets covering one window"""
+
+    __slots__ = ("limit", "counts", "amounts", "epoch", "count", "amount")
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.counts = [0] * limit.buckets
+        self.amounts = [0] * limit.buckets
+        self.epoch = None   # bucket number of the newest bucket
+        self.count = 0      # totals over the buckets in the window
+        self.amount = 0
+
+    def _advance(self, now):
+        """Clears the buckets that have slid out of the window"""
+        epoch = int(now / self.limit.bucket_width)
+        if self.epoch is None:
+            self.epoch = epoch
+            return
+        steps = min(epoch - self.epoch, self.limit.buckets)
+        for step in range(1, steps + 1):
+            index = (self.epoch + step) % self.limit.buckets
+            self.count -= self.counts[index]
+            self.amount -= self.amounts[index]
+            self.counts[index] = 0
+            self.amounts[index] = 0
+        if epoch > self.epoch:
+            self.epoch = epoch
+
+    def allows(self, amount, now):
+        """True if one more authorization of amount stays within the limit"""
+        self._advance(now)
+        limit = self.limit
+        if limit.max_count is not None and self.count + 1 > limit.max_count:
+            return False
+        if limit.max_amount is not None and self.amount + amount > limit.max_amount:
+            return False
+        return True
+
+    def record(self, amount, now):
+        self._advance(now)
+        index = self.epoch % self.limit.buckets
+        self.counts[index] += 1
+        self.amounts[index] += amount
+        self.count += 1
+        self.amount += amount
+
+    def unrecord(self, amount, recorded_at):
+        """Takes back an authorization recorded at recorded_at, if it is still in the window"""
+        epoch = int(recorded_at / self.limit.bucket_width)
+        if self.epoch is None or self.epoch - epoch >= self.limit.buckets:
+            return
+        index = epoch % self.limit.buckets
+        if self.counts[index] > 0:
+            self.counts[index] -= 1
+            self.amounts[index] -= amount
+            self.count -= 1
+            self.amount -= amount
+
+
+class _KeyedWindows:
+    """The windows of every key of one kind (cards or merchants)"""
+
+    def __init__(self, limits, max_keys):
+        self.limits = limits
+        self.max_keys = max_keys
+        self.idle = max([limit.window for limit in limits] or [0])
+        self.keys = collections.OrderedDict()   # key -> (last seen, [SlidingWindow])
+        self.evictions = 0
+
+    def windows(self, key, now):
+        entry = self.keys.get(key)
+        if entry is None:
+            windows = [SlidingWindow(limit) for limit in self.limits]
+        else:
+            windows = entry[1]
+            self.keys.move_to_end(key)
+        self.keys[key] = (now, windows)
+        self._evict(now)
+        return windows
+
+    def _evict(self, now):
+        """Drops least recently used keys that are idle or over max_keys"""
+        while self.keys:
+            key, (last_seen, _) = next(iter(self.keys.items()))
+            if len(self.keys) > self.max_keys or now - last_seen > self.idle:
+                del self.keys[key]
+                self.evictions += 1
+            else:
+                break
+
+
+class VelocityTracker:
+    """Sliding-window authorization counts and amounts per card and per merchant"""
+
+    def __init__(self, card_limits=(), merchant_limits=(), max_keys=DEFAULT_MAX_KEYS,
+                 clock=time.monotonic):
+        self.clock = clock
+        self._cards = _KeyedWindows(list(card_limits), max_keys)
+        self._merchants = _KeyedWindows(list(merchant_limits), max_keys)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def card_key(card_id):
+        return _NON_DIGITS.sub('', str(card_id))
+
+    def check_and_record(self, card_id, network_id, amount):
+        """
+        Counts an authorization against the card and the merchant if both allow it,
+        as one step. Returns (refused, recorded_at): refused is None, "card" or
+        "merchant"; recorded_at is the time to pass to unrecord, if it was counted.
+        """
+        with self._lock:
+            now = self.clock()
+            card_windows = self._cards.windows(self.card_key(card_id), now)
+            if not all(w.allows(amount, now) for w in card_windows):
+                return "card", None
+            merchant_windows = self._merchants.windows(str(network_id), now)
+            if not all(w.allows(amount, now) for w in merchant_windows):
+                return "merchant", None
+            for window in card_windows:
+                window.record(amount, now)
+            for window in merchant_windows:
+                window.record(amount, now)
+            return None, now
+
+    def unrecord(self, card_id, network_id, amount, recorded_at):
+        """Takes back an authorization counted by check_and_record"""
+        with self._lock:
+            for key, keyed in ((self.card_key(card_id), self._cards),
+                               (str(network_id), self._merchants)):
+                entry = keyed.keys.get(key)
+                if entry is not None:
+                    for window in entry[1]:
+                        window.unrecord(amount, recorded_at)
+
+    def stats(self):
+        return {
+            "cards": len(self._cards.keys),
+            "merchants": len(self._merchants.keys),
+            "card_evictions": self._cards.evictions,
+            "merchant_evictions": self._merchants.evictions,
+        }
+
+
+def velocity_rules(tracker):
+    """
+    Authorization rules for the tracker's limits, in any position in the pipeline.
+    Whichever runs first checks both limits and records the authorization in one
+    tracker step; if a later rule rejects the transaction, the record is undone.
+    """
+    def verdict(data, context):
+        """The refusal ("card", "merchant" or None) of this run's check_and_record"""
+        if "velocity" not in context:
+            card_id = card_of(data).get("id")
+            merchant_data = data.get("merchant_data")
+            network_id = merchant_data.get("network_id") \
+                if isinstance(merchant_data, dict) else None
+            amount = context["amount"]
+            if card_id is None or network_id is None or amount is None:
+                # Not a transaction that can be counted: refused as the card's
+                context["velocity"] = "card"
+                return "card"
+            refused, recorded_at = tracker.check_and_record(card_id, network_id, amount)
+            context["velocity"] = refused
+            if recorded_at is not None:
+                context["velocity_recorded"] = (card_id, network_id, amount, recorded_at)
+        return context["velocity"]
+
+    def undo(data, context):
+        recorded = context.pop("velocity_recorded", None)
+        if recorded is not None:
+            tracker.unrecord(*recorded)
+
+    def check_card_velocity(data, context):
+        return verdict(data, context) != "card"
+
+    def check_merchant_velocity(data, context):
+        return verdict(data, context) != "merchant"
+
+    return [
+        Rule("card_velocity", CARD_VELOCITY_FAILURE, "Card authorization rate exceeded",
+             check_card_velocity, "authorized", undo=undo),
+        Rule("merchant_velocity", MERCHANT_VELOCITY_FAILURE,
+             "Merchant authorization rate exceeded", check_merchant_velocity, "authorized",
+             undo=undo),
+    ]
@@ -0,0 +1,248 @@
+"""
+   Author: M I Schwartz
+
+   MessagePack encoding of transactions, settlements and store listings,
+   as a compact binary alternative to JSON on the wire.
+
+   The structures are exactly those documented in README.md, encoded as
+   MessagePack maps, arrays, strings, integers, floats, booleans and nil.
+   The service selects it by Content-Type (requests) and Accept (responses):
+       application/msgpack   (application/x-msgpack is also accepted)
+   JSON stays the default.
+
+   The msgpack package (requirements.txt) is used when it is installed; it is
+   a C extension. Otherwise the pure Python packb / unpackb below produce the
+   same bytes, but several times slower than the json module, so the fallback
+   is for development only: install msgpack where the service takes traffic.
+   Either way a malformed body raises ValueError, and so do bin and ext
+   values: what is decoded must also be expressible as JSON, since it is
+   answered, listed and archived as JSON.
+"""
+
+import struct
+
+CONTENT_TYPE = "application/msgpack"
+CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def is_msgpack(content_type):
+    """True if a Content-Type or Accept header value names MessagePack"""
+    if not content_type:
+        return False
+    for item in content_type.split(","):
+        if item.split(";")[0].strip().lower() in CONTENT_TYPES:
+            return True
+    return False
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(b"\xc0")
+    elif obj is True:
+        out.append(b"\xc3")
+    elif obj is False:
+        out.append(b"\xc2")
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(struct.pack("B", obj))
+        elif -0x20 <= obj < 0:
+            out.append(struct.pack("b", obj))
+        elif 0 <= obj <= 0xff:
+            out.append(struct.pack(">BB", 0xcc, obj))
+        elif 0 <= obj <= 0xffff:
+            out.append(struct.pack(">BH", 0xcd, obj))
+        elif 0 <= obj <= 0xffffffff:
+            out.append(struct.pack(">BI", 0xce, obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out.append(struct.pack(">BQ", 0xcf, obj))
+        elif -0x80 <= obj < 0:
+            out.append(struct.pack(">Bb", 0xd0, obj))
+        elif -0x8000 <= obj < 0:
+            out.append(struct.pack(">Bh", 0xd1, obj))
+        elif -0x80000000 <= obj < 0:
+            out.append(struct.pack(">Bi", 0xd2, obj))
+        elif -0x8000000000000000 <= obj < 0:
+            out.append(struct.pack(">Bq", 0xd3, obj))
+        else:
+            raise ValueError("Integer out of MessagePack range")
+    elif isinstance(obj, float):
+        out.append(struct.pack(">Bd", 0xcb, obj))
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            out.append(struct.pack("B", 0xa0 | length))
+        elif length < 0x100:
+            out.append(struct.pack(">BB", 0xd9, length))
+        elif length < 0x10000:
+            out.append(struct.pack(">BH", 0xda, length))
+        else:
+            out.append(struct.pack(">BI", 0xdb, length))
+        out.append(data)
+    elif isinstance(obj, (bytes, bytearray)):
+        length = len(obj)
+        if length < 0x100:
+            out.append(struct.pack(">BB", 0xc4, length))
+        elif length < 0x10000:
+            out.append(struct.pack(">BH", 0xc5, length))
+        else:
+            out.append(struct.pack(">BI", 0xc6, length))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        length = len(obj)
+        if length < 16:
+            out.append(struct.pack("B", 0x90 | length))
+        elif length < 0x10000:
+            out.append(struct.pack(">BH", 0xdc, length))
+        else:
+            out.append(struct.pack(">BI", 0xdd, length))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        length = len(obj)
+        if length < 16:
+            out.append(struct.pack("B", 0x80 | length))
+        elif length < 0x10000:
+            out.append(struct.pack(">BH", 0xde, length))
+        else:
+            out.append(struct.pack(">BI", 0xdf, length))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError("Cannot encode %s as MessagePack" % type(obj).__name__)
+
+
+def _py_packb(obj):
+    out = []
+    _pack(obj, out)
+    return b"".join(out)
+
+
+_FIXED = {
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+    0xca: (">f", 4), 0xcb: (">d", 8),
+}
+_LENGTH = {
+    0xd9: (">B", 1, "str"), 0xda: (">H", 2, "str"), 0xdb: (">I", 4, "str"),
+    0xc4: (">B", 1, "bin"), 0xc5: (">H", 2, "bin"), 0xc6: (">I", 4, "bin"),
+    0xdc: (">H", 2, "array"), 0xdd: (">I", 4, "array"),
+    0xde: (">H", 2, "map"), 0xdf: (">I", 4, "map"),
+}
+
+
+def _unpack(data, offset):
+    """Returns (object, next offset)"""
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if 0xa0 <= code <= 0xbf:
+        return _unpack_raw(data, offset, code & 0x1f, "str")
+    if 0x90 <= code <= 0x9f:
+        return _unpack_array(data, offset, code & 0x0f)
+    if 0x80 <= code <= 0x8f:
+        return _unpack_map(data, offset, code & 0x0f)
+    if code == 0xc0:
+        return None, offset
+    if code == 0xc2:
+        return False, offset
+    if code == 0xc3:
+        return True, offset
+    if code in _FIXED:
+        fmt, size = _FIXED[code]
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+    if code in _LENGTH:
+        fmt, size, kind = _LENGTH[code]
+        length = struct.unpack_from(fmt, data, offset)[0]
+        offset += size
+        if kind in ("str", "bin"):
+            return _unpack_raw(data, offset, length, kind)
+        if kind == "array":
+            return _unpack_array(data, offset, length)
+        return _unpack_map(data, offset, length)
+    raise ValueError("Unsupported MessagePack type 0x%02x" % code)
+
+
+def _unpack_raw(data, offset, length, kind):
+    end = offset + length
+    if end > len(data):
+        raise IndexError("truncated " + kind)
+    if kind == "str":
+        return data[offset:end].decode("utf-8"), end
+    raise ValueError("MessagePack bin values are not accepted")
+
+
+def _unpack_array(data, offset, length):
+    result = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset)
+        result.append(item)
+    return result, offset
+
+
+def _unpack_map(data, offset, length):
+    result = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset)
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+
+
+def _py_unpackb(data):
+    try:
+        obj, offset = _unpack(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError, RecursionError) as err:
+        # TypeError: an unhashable map key; RecursionError: nesting too deep
+        raise ValueError("Malformed MessagePack: %s" % err)
+    if offset != len(data):
+        raise ValueError("Extra data after MessagePack object")
+    return obj
+
+
+def _reject_bytes(obj):
+    """Raises ValueError if a decoded object holds bytes anywhere"""
+    pending = [obj]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, bytes):
+            raise ValueError("MessagePack bin values are not accepted")
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            pending.extend(item)
+
+
+def _no_ext(code, data):
+    raise ValueError("MessagePack ext values are not accepted")
+
+
+try:
+    import msgpack as _msgpack
+
+    def packb(obj):
+        """Encodes obj as MessagePack bytes"""
+        return _msgpack.packb(obj, use_bin_type=True)
+
+    def unpackb(data):
+        """Decodes MessagePack bytes"""
+        try:
+            # max_bin_len=0 refuses every bin value but an empty one (c4 00);
+            # only a body holding those bytes needs walking to find it
+            obj = _msgpack.unpackb(data, raw=False, strict_map_key=False,
+                                   max_bin_len=0, ext_hook=_no_ext)
+        except (_msgpack.ExtraData, _msgpack.FormatError, _msgpack.StackError,
+                ValueError, TypeError, RecursionError) as err:
+            raise ValueError("Malformed MessagePack: %s" % err)
+        if b"\xc4\x00" in data:
+            _reject_bytes(obj)
+        return obj
+except ImportError:
+    packb = _py_packb
+    unpackb = _py_unpackb
+    packb.__doc__ = "Encodes obj as MessagePack bytes"
+    unpackb.__doc__ = "Decodes MessagePack bytes"